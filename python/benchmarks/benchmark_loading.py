@@ -0,0 +1,165 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nrrd
+
+# The loaders are written as sibling scripts, so make them importable the same way
+loading_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "loading")
+if loading_dir not in sys.path:
+    sys.path.append(loading_dir)
+
+
+# Fixture sweeps: case count, slices, in-plane size and frame count
+configs = [
+    {"cases": 4, "slices": 19, "size": 64, "frames": 8, "encoding": "raw"},
+    {"cases": 4, "slices": 19, "size": 64, "frames": 8, "encoding": "gzip"},
+    {"cases": 16, "slices": 19, "size": 64, "frames": 8, "encoding": "gzip"},
+    {"cases": 4, "slices": 19, "size": 256, "frames": 8, "encoding": "gzip"},
+    {"cases": 4, "slices": 19, "size": 64, "frames": 32, "encoding": "gzip"},
+]
+tolerance = 0.25    # fractional slowdown (or RSS growth) over baseline that counts as a regression
+
+
+def config_name(config: dict) -> str:
+    return f"{config['cases']}c_{config['slices']}x{config['size']}_{config['frames']}f_{config['encoding']}"
+
+
+def make_fixtures(root: str, config: dict) -> str:
+    """Write a synthetic simulated dataset and a matching Utah-style dataset under root, returning the dataset name."""
+    name = config_name(config)
+    rng = np.random.default_rng(0)
+    sim_dir = os.path.join(root, "data", "unprocessed", name)
+    utah_dir = os.path.join(root, "data", "downloaded", f"2018_UTAH_MICCAI_{name}", "Training Set")
+    os.makedirs(sim_dir, exist_ok=True)
+
+    shape = (config["size"], config["size"], config["slices"], config["frames"])
+    for case_i in range(config["cases"]):
+        # Smooth-ish intensities and blocky labels so compression behaves roughly like scanner output
+        vol = (rng.random(shape, dtype=np.float32) * 64 + np.linspace(0, 512, shape[0], dtype=np.float32)[:, None, None, None])
+        seg = np.zeros(shape, dtype=np.uint8)
+        seg[shape[0] // 4:3 * shape[0] // 4, shape[1] // 4:3 * shape[1] // 4] = case_i % 8 + 1
+        nrrd.write(os.path.join(sim_dir, f"case_{case_i:05d}_vol.nrrd"), vol, {"encoding": config["encoding"]})
+        nrrd.write(os.path.join(sim_dir, f"case_{case_i:05d}_seg.nrrd"), seg, {"encoding": config["encoding"]})
+
+        patient_dir = os.path.join(utah_dir, f"patient_{case_i:05d}")
+        os.makedirs(patient_dir, exist_ok=True)
+        nrrd.write(os.path.join(patient_dir, "lgemri.nrrd"), (vol[..., 0] / 4).astype(np.uint8), {"encoding": config["encoding"]})
+    return name
+
+
+def peak_rss_mb() -> float:
+    # Include pool workers the benchmark spawned
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024 if platform.system() != "Darwin" else peak / 1024**2
+
+
+def run_path(root: str, dataset: str, path_name: str) -> dict:
+    """Time one loading/conversion path in this (fresh) process."""
+    os.chdir(root)
+    import simulated_nrrd_loader
+    vol_paths = simulated_nrrd_loader.get_dataset_paths([dataset])
+    all_paths = vol_paths + [path.replace("_vol", "_seg") for path in vol_paths]
+    n_bytes = sum(os.path.getsize(path) for path in all_paths)
+    n_files = len(all_paths)
+
+    # Converters resume from their manifests, so always start from an empty output directory
+    shutil.rmtree(os.path.join(root, "data", "png"), ignore_errors=True)
+
+    start = time.perf_counter()
+    if path_name == "load_file_as_np":
+        for path in all_paths:
+            simulated_nrrd_loader.load_file_as_np(path)
+    elif path_name == "load_data_as_np":
+        simulated_nrrd_loader.load_data_as_np([dataset])
+    elif path_name == "load_data_as_tensors":
+        simulated_nrrd_loader.load_data_as_tensors([dataset])
+    elif path_name == "nrrd2png_simulated":
+        import nrrd2png_simulated
+        nrrd2png_simulated.in_dir = os.path.join(root, "data", "unprocessed")
+        nrrd2png_simulated.out_dir = os.path.join(root, "data", "png")
+        nrrd2png_simulated.dataset = dataset
+        nrrd2png_simulated.main()
+    elif path_name == "nrrd2png_2018_utah_miccai":
+        import nrrd2png_2018_utah_miccai
+        nrrd2png_2018_utah_miccai.dataset_name = f"2018_UTAH_MICCAI_{dataset}"
+        nrrd2png_2018_utah_miccai.dataset_dir = os.path.join(root, "data", "downloaded", nrrd2png_2018_utah_miccai.dataset_name)
+        nrrd2png_2018_utah_miccai.out_dir = os.path.join(root, "data", "png")
+        utah_paths = glob.glob(f"{nrrd2png_2018_utah_miccai.dataset_dir}/*/*/lgemri.nrrd")
+        n_bytes, n_files = sum(os.path.getsize(path) for path in utah_paths), len(utah_paths)
+        nrrd2png_2018_utah_miccai.main()
+    else:
+        raise ValueError(f"Unknown benchmark path: \"{path_name}\"")
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "files_per_s": n_files / seconds,
+        "mb_per_s": n_bytes / 1e6 / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+paths = ["load_file_as_np", "load_data_as_np", "load_data_as_tensors", "nrrd2png_simulated", "nrrd2png_2018_utah_miccai"]
+
+
+def run(work_dir: str, selected_paths=paths) -> dict:
+    results = {}
+    spawn = multiprocessing.get_context("spawn")
+    for config in configs:
+        dataset = make_fixtures(work_dir, config)
+        for path_name in selected_paths:
+            # A fresh interpreter per measurement keeps peak RSS and warm caches from leaking between paths
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                result = executor.submit(run_path, work_dir, dataset, path_name).result()
+            results[f"{path_name}/{dataset}"] = result
+            print(f"{path_name:28s} {dataset:28s} {result['seconds']:8.3f}s {result['files_per_s']:9.1f} files/s "
+                  f"{result['mb_per_s']:8.1f} MB/s {result['peak_rss_mb']:8.1f} MB peak")
+    return results
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    """List the benchmarks that got slower (or heavier) than the baseline by more than the tolerance."""
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if result[metric] > baseline[key][metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {baseline[key][metric]:.3f} -> {result[metric]:.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the nrrd loading and conversion paths on synthetic fixtures.")
+    parser.add_argument("--work-dir", help="where fixtures and outputs are written (a temporary directory by default)")
+    parser.add_argument("--paths", nargs="+", default=paths, choices=paths)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="previous results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to --baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run(os.path.abspath(args.work_dir or tmp_dir), args.paths)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=1)
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
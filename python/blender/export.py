@@ -4,6 +4,7 @@ import init
 import sys
 
 import fixups
+import numpy as np
 
 # Install tqdm in the python blender environment
 import subprocess
@@ -35,6 +36,11 @@ def export_heart(rel_dir: str, filename: str, export_format: str) -> bool:
         print(f"Trying to export file to {abs_dir}/{filename}.fbx")
         success = _export_fbx_discontinuous(abs_dir, filename)
         return success
+    elif "npz" in export_format.lower():
+        # Call npz export method
+        print(f"Trying to export files to {abs_dir}/{filename}_frame_N.npz")
+        success = _export_npz(abs_dir, filename)
+        return success
     elif "abc" in export_format.lower() or "alembic" in export_format.lower():
         # Call abc export method
         print(f"Trying to export file to {abs_dir}/{filename}.abc")
@@ -100,6 +106,42 @@ def _export_fbx_discontinuous(abs_dir: str, filename:str) -> bool:
     return True
 
 
+def _export_npz(abs_dir: str, filename: str) -> bool:
+    """Save the evaluated (deformed) triangle mesh of every component, one file per scene frame, for the CPU voxelizer."""
+    scene = bpy.context.scene
+    objs = [obj for obj in bpy.data.objects if obj.type == 'MESH']
+    for frame in tqdm(range(scene.frame_start, scene.frame_end + 1)):
+        # Set scene anim to frame and re-evaluate the armature deformation
+        scene.frame_set(frame)
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+        arrays = {}
+        for obj in objs:
+            evaluated = obj.evaluated_get(depsgraph)
+            mesh = evaluated.to_mesh()
+            mesh.calc_loop_triangles()
+
+            # World-space vertices and triangle indices
+            vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+            mesh.vertices.foreach_get("co", vertices)
+            vertices = vertices.reshape(-1, 3)
+            matrix = np.array(obj.matrix_world, dtype=np.float32)
+            vertices = vertices @ matrix[:3, :3].T + matrix[:3, 3]
+            faces = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get("vertices", faces)
+            evaluated.to_mesh_clear()
+
+            # Strip frame suffixes and duplicate numbering so arrays are keyed by component
+            name = obj.name.split("_")[0].split(".")[0]
+            arrays[f"{name}_vertices"] = vertices
+            arrays[f"{name}_faces"] = faces.reshape(-1, 3)
+
+        filepath = os.path.join(abs_dir, f"{filename}_frame_{frame}.npz")
+        np.savez_compressed(filepath, **arrays)
+
+    print(f"Successfully saved {scene.frame_end - scene.frame_start + 1} NPZ files to \"{abs_dir}\"")
+    return True
+
 
 def _export_abc(abs_dir: str, filename:str) -> bool:
     bpy.ops.object.select_all(action='DESELECT')
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from tqdm import tqdm
+
+import simulated_nrrd_loader
+
+
+catalog_path = f"{Path('./').parent.absolute()}/data/catalog.sqlite"
+num_workers = os.cpu_count()
+n_labels = 9    # background plus the eight heart components
+
+schema = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    vol_path TEXT NOT NULL,
+    seg_path TEXT NOT NULL,
+    vol_mtime_ns INTEGER NOT NULL,
+    seg_size INTEGER NOT NULL,
+    seg_mtime_ns INTEGER NOT NULL,
+    n_frames INTEGER NOT NULL,
+    n_slices INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    vol_dtype TEXT NOT NULL,
+    seg_dtype TEXT NOT NULL,
+    spacing TEXT,
+    shape_mismatch INTEGER NOT NULL,
+    UNIQUE (dataset, name)
+);
+CREATE TABLE IF NOT EXISTS slice_labels (
+    case_id INTEGER NOT NULL REFERENCES cases(id) ON DELETE CASCADE,
+    frame INTEGER NOT NULL,
+    slice INTEGER NOT NULL,
+    label INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slice_labels_by_label ON slice_labels (label, case_id);
+CREATE INDEX IF NOT EXISTS slice_labels_by_case ON slice_labels (case_id, frame, slice);
+CREATE INDEX IF NOT EXISTS cases_by_shape ON cases (n_slices, width, height);
+"""
+
+
+def connect(path=catalog_path) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(schema)
+    return conn
+
+
+def scan_case(dataset: str, vol_path: str) -> tuple[dict, np.ndarray]:
+    """Read both headers and make one pass over the labels, returning the case row and its label counts.
+
+    Counts are shaped (frame, slice, label) in the same frame/slice indexing the loaders use."""
+    seg_path = vol_path.replace("_vol", "_seg")
+    vol_header, _ = simulated_nrrd_loader.read_header(vol_path)
+    seg_header, seg_offset = simulated_nrrd_loader.read_header(seg_path)
+    sizes = [int(size) for size in seg_header["sizes"]]
+    n_frames = sizes[3] if len(sizes) == 4 else 1
+    stat = os.stat(seg_path)
+
+    # Count labels per slice with a single bincount per frame
+    counts = np.zeros((n_frames, sizes[2], n_labels), dtype=np.int64)
+    slice_ids = np.broadcast_to(np.arange(sizes[2]) * n_labels, sizes[:3])
+    for frame_i, frame in enumerate(simulated_nrrd_loader.iter_file_frames(seg_path, seg_header, seg_offset)):
+        labels = np.asarray(frame).astype(np.int64)
+        valid = (labels >= 0) & (labels < n_labels)
+        counts[frame_i] = np.bincount((slice_ids + labels)[valid], minlength=sizes[2] * n_labels).reshape(sizes[2], n_labels)
+
+    row = {
+        "dataset": dataset,
+        "name": os.path.basename(vol_path)[:-len("_vol.nrrd")],
+        "vol_path": os.path.abspath(vol_path),
+        "seg_path": os.path.abspath(seg_path),
+        "vol_mtime_ns": os.stat(vol_path).st_mtime_ns,
+        "seg_size": stat.st_size,
+        "seg_mtime_ns": stat.st_mtime_ns,
+        "n_frames": n_frames,
+        "n_slices": sizes[2],
+        "width": sizes[0],
+        "height": sizes[1],
+        "vol_dtype": str(simulated_nrrd_loader.header_dtype(vol_header)),
+        "seg_dtype": str(simulated_nrrd_loader.header_dtype(seg_header)),
+        "spacing": json.dumps(simulated_nrrd_loader.header_spacing(vol_header)),
+        "shape_mismatch": int(list(vol_header["sizes"]) != list(seg_header["sizes"])),
+    }
+    return row, counts
+
+
+def build(active_datasets, path=catalog_path) -> sqlite3.Connection:
+    """Add or refresh every case of the given datasets, skipping those whose files are unchanged."""
+    conn = connect(path)
+    known = {(dataset, name): tuple(stamp) for dataset, name, *stamp in
+             conn.execute("SELECT dataset, name, vol_mtime_ns, seg_size, seg_mtime_ns FROM cases")}
+
+    # Only rescan new or modified cases
+    jobs = []
+    for dataset in active_datasets:
+        for vol_path in simulated_nrrd_loader.get_dataset_paths([dataset]):
+            name = os.path.basename(vol_path)[:-len("_vol.nrrd")]
+            stat = os.stat(vol_path.replace("_vol", "_seg"))
+            if known.get((dataset, name)) != (os.stat(vol_path).st_mtime_ns, stat.st_size, stat.st_mtime_ns):
+                jobs.append((dataset, vol_path))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(scan_case, *zip(*jobs)) if jobs else []
+        for row, counts in tqdm(results, total=len(jobs), desc="Cataloging"):
+            conn.execute("DELETE FROM cases WHERE dataset = ? AND name = ?", (row["dataset"], row["name"]))
+            case_id = conn.execute(f"INSERT INTO cases ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                                   tuple(row.values())).lastrowid
+
+            # Store only the non-zero counts
+            frames, slices, labels = np.nonzero(counts)
+            conn.executemany("INSERT INTO slice_labels VALUES (?, ?, ?, ?, ?)",
+                             zip([case_id] * len(frames), frames.tolist(), slices.tolist(), labels.tolist(),
+                                 counts[frames, slices, labels].tolist()))
+            if row["shape_mismatch"]:
+                print(f"Warning: vol/seg shape mismatch in {row['dataset']}/{row['name']}")
+            conn.commit()
+
+    return conn
+
+
+def slices_with_label(conn, label: int, min_count=1, dataset=None) -> list[tuple]:
+    """(dataset, case name, frame, slice, count) for every slice containing the label."""
+    query = ("SELECT c.dataset, c.name, s.frame, s.slice, s.count FROM slice_labels s JOIN cases c ON c.id = s.case_id "
+             "WHERE s.label = ? AND s.count >= ?")
+    params = [label, min_count]
+    if dataset is not None:
+        query += " AND c.dataset = ?"
+        params.append(dataset)
+    return conn.execute(query, params).fetchall()
+
+
+def cases_with_shape(conn, n_slices: int, size: int = None) -> list[tuple]:
+    """(dataset, case name) for every case with the given slice count and, optionally, square in-plane size."""
+    query = "SELECT dataset, name FROM cases WHERE n_slices = ?"
+    params = [n_slices]
+    if size is not None:
+        query += " AND width = ? AND height = ?"
+        params.extend([size, size])
+    return conn.execute(query, params).fetchall()
+
+
+def label_totals(conn, dataset=None) -> dict:
+    """Voxel count per label across the catalog."""
+    query = "SELECT s.label, SUM(s.count) FROM slice_labels s JOIN cases c ON c.id = s.case_id"
+    params = []
+    if dataset is not None:
+        query += " WHERE c.dataset = ?"
+        params.append(dataset)
+    return dict(conn.execute(query + " GROUP BY s.label", params).fetchall())
+
+
+def mismatched_cases(conn) -> list[tuple]:
+    return conn.execute("SELECT dataset, name FROM cases WHERE shape_mismatch = 1").fetchall()
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    conn = build(active_datasets)
+    print(f"dataset(s): {active_datasets}")
+    for label, count in sorted(label_totals(conn).items()):
+        print(f"{label}: {count}")
+    for dataset, name in mismatched_cases(conn):
+        print(f"shape mismatch: {dataset}/{name}")
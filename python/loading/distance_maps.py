@@ -0,0 +1,176 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from scipy import ndimage
+from tqdm import tqdm
+
+import generate_phantoms
+import nrrd_cache
+import simulated_nrrd_loader
+
+
+index_name = "distance_index.json"      # kept in the dataset's nrrd_cache directory, next to the maps
+num_workers = os.cpu_count()
+mode = "2d"                             # "2d" (within each slice) or "3d" (within each frame, across slices)
+labels = sorted(generate_phantoms.LABELS.values())
+units_per_mm = 10                       # int16 steps per mm, so maps saturate at +-3276.7 mm
+
+# Maps are (frame, slice, label, a, b) int16 in the loaders' reordered layout: negative inside a label, positive
+# outside, in units of 1 / units_per_mm millimetres. A label missing from (or filling) a slice (2d) or frame (3d)
+# saturates at the int16 limits everywhere, as there is no boundary to measure from.
+NO_BOUNDARY = np.iinfo(np.int16).max
+
+
+def voxel_spacing(header: dict) -> np.ndarray:
+    """Millimetre spacing of the (x, y, slice) axes, 1 where the header gives none."""
+    if "space directions" in header:
+        directions = np.array(header["space directions"], dtype=float)[:3]
+        return np.nan_to_num(np.linalg.norm(directions, axis=1), nan=1.0)
+    if "spacings" in header:
+        return np.nan_to_num(np.array(header["spacings"], dtype=float)[:3], nan=1.0)
+    return np.ones(3)
+
+
+def signed_distance(mask: np.ndarray, sampling) -> np.ndarray:
+    """Exact signed Euclidean distance (mm) to the boundary of a boolean mask, negative inside.
+
+    Each side is measured to the nearest voxel of the other, so the voxels on either side of the boundary sit one
+    voxel from zero."""
+    if not mask.any() or mask.all():
+        return np.full(mask.shape, -np.inf if mask.any() else np.inf)
+    outside = ndimage.distance_transform_edt(~mask, sampling=sampling)
+    inside = ndimage.distance_transform_edt(mask, sampling=sampling)
+    return outside - inside
+
+
+def quantize(distance: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(distance * units_per_mm), -NO_BOUNDARY, NO_BOUNDARY).astype(np.int16)
+
+
+def frame_distance_maps(frame: np.ndarray, spacing, mode=mode, labels=labels) -> np.ndarray:
+    """(slice, label, a, b) int16 maps of one (slice, a, b) label frame."""
+    out = np.empty((frame.shape[0], len(labels), *frame.shape[1:]), dtype=np.int16)
+    for label_i, label in enumerate(labels):
+        mask = frame == label
+        if mode == "3d":
+            out[:, label_i] = quantize(signed_distance(mask, spacing))
+        elif mode == "2d":
+            for slice_i in range(len(mask)):
+                out[slice_i, label_i] = quantize(signed_distance(mask[slice_i], spacing[1:]))
+        else:
+            raise ValueError(f"Unknown distance map mode: \"{mode}\"")
+    return out
+
+
+def compile_file(seg_path: str, out_path: str, reorder, mode=mode, labels=labels):
+    """Write the distance maps of one segmentation into a .npy, a frame at a time."""
+    if reorder[0] != 3:
+        raise ValueError(f"Distance maps need the frame axis first, got reorder={reorder}")
+    frame_axes = tuple(reorder[1:])
+    header, data_offset = simulated_nrrd_loader.read_header(seg_path)
+    sizes = [int(size) for size in header["sizes"]]
+    spacing = voxel_spacing(header)[list(frame_axes)]
+    shape = (sizes[3] if len(sizes) == 4 else 1, sizes[frame_axes[0]], len(labels), *(sizes[axis] for axis in frame_axes[1:]))
+
+    # Per-process temporary names, as every rank of a distributed run compiles the same maps
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int16, shape=shape)
+    for frame_i, frame in enumerate(simulated_nrrd_loader.iter_file_frames(seg_path, header, data_offset)):
+        out[frame_i] = frame_distance_maps(np.transpose(frame, frame_axes), spacing, mode, labels)
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+
+
+def map_path(dataset: str, seg_path: str) -> str:
+    return os.path.join(nrrd_cache.cache_dir, dataset, os.path.basename(seg_path).replace("_seg.nrrd", "_sdf.npy"))
+
+
+def entry_key(seg_path: str, reorder, mode=mode, labels=labels) -> dict:
+    return nrrd_cache.source_key(seg_path, reorder, np.int16) | {"mode": mode, "labels": list(labels),
+                                                                 "units_per_mm": units_per_mm}
+
+
+def load_index(dataset: str) -> dict:
+    index_path = os.path.join(nrrd_cache.cache_dir, dataset, index_name)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def compile_dataset(dataset: str, reorder=(3, 2, 1, 0), mode=mode, labels=labels) -> dict:
+    """Compute the distance maps of every segmentation in a dataset, skipping those whose source is unchanged."""
+    os.makedirs(os.path.join(nrrd_cache.cache_dir, dataset), exist_ok=True)
+    index = load_index(dataset)
+    seg_paths = [path.replace("_vol", "_seg") for path in simulated_nrrd_loader.get_dataset_paths([dataset])]
+    jobs = [seg_path for seg_path in seg_paths if index.get(os.path.basename(map_path(dataset, seg_path))) !=
+            entry_key(seg_path, reorder, mode, labels) or not os.path.exists(map_path(dataset, seg_path))]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(compile_file, seg_path, map_path(dataset, seg_path), reorder, mode, labels): seg_path
+                   for seg_path in jobs}
+        for future in tqdm(futures, desc=f"Distance maps of {dataset}"):
+            future.result()
+            seg_path = futures[future]
+            index[os.path.basename(map_path(dataset, seg_path))] = entry_key(seg_path, reorder, mode, labels)
+
+            # Save as maps finish so an interrupted compile resumes
+            index_path = os.path.join(nrrd_cache.cache_dir, dataset, index_name)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp_path, index_path)
+    return index
+
+
+def load_distance_map(dataset: str, seg_path: str, index=None) -> np.ndarray:
+    """Map a compiled (frame, slice, label, a, b) distance map, or return None if it is missing or out of date."""
+    index = load_index(dataset) if index is None else index
+    entry = index.get(os.path.basename(map_path(dataset, seg_path)))
+    if entry is None or not os.path.exists(map_path(dataset, seg_path)) or \
+            entry != entry_key(seg_path, entry["reorder"], entry["mode"], entry["labels"]):
+        return None
+    return np.load(map_path(dataset, seg_path), mmap_mode="c")
+
+
+def to_mm(distances: torch.Tensor) -> torch.Tensor:
+    """Quantized maps back to float32 millimetres (saturated entries become +-inf)."""
+    out = distances.float() / units_per_mm
+    out[distances == NO_BOUNDARY] = float("inf")
+    out[distances == -NO_BOUNDARY] = -float("inf")
+    return out
+
+
+def load_with_distance_maps(active_datasets, reorder=(3, 2, 1, 0), mode=mode, labels=labels, **kwargs):
+    """Like nrrd_cache.load_cached_tensors (which takes the remaining arguments), with each split's (volumes, labels)
+    joined by their distance maps.
+
+    Everything is served as maps of the caches, so frames are only read when they are indexed."""
+    distance_indexes = {dataset: compile_dataset(dataset, reorder, mode, labels) for dataset in active_datasets}
+    out = []
+    for cases in nrrd_cache.cached_splits(active_datasets, reorder=reorder, **kwargs):
+        volumes, masks, distances = [], [], []
+        for dataset, path, index in cases:
+            volume, mask = nrrd_cache.load_cached_case(dataset, path, index)
+            seg_path = path.replace("_vol", "_seg")
+            distance = load_distance_map(dataset, seg_path, distance_indexes[dataset])
+            if distance is None:
+                raise simulated_nrrd_loader.DatasetError(f"No up-to-date distance map of {seg_path} in '"
+                                                         f"{nrrd_cache.cache_dir}/{dataset}' (did it change after "
+                                                         f"compiling?)")
+            volumes.append(volume)
+            masks.append(mask)
+            distances.append(torch.from_numpy(distance))
+        out.append((volumes, masks, distances))
+    return tuple(out)
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    for dataset in active_datasets:
+        index = compile_dataset(dataset)
+        size = sum(os.path.getsize(os.path.join(nrrd_cache.cache_dir, dataset, name)) for name in index)
+        print(f"{dataset}: {len(index)} distance map(s), {size / 1e6:.1f} MB")
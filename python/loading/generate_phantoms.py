@@ -0,0 +1,254 @@
+from pathlib import Path
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nrrd
+from tqdm import tqdm
+
+
+anim_data_path = str(Path(__file__).resolve().parents[2] / "assets" / "anim_data.csv")    # repo assets, from any cwd
+out_dir = f"{Path('./').parent.absolute()}/data/unprocessed"
+dataset = "phantom_19x256"
+n_cases = 1000
+seed = 0
+num_workers = os.cpu_count()
+n_frames = 20                   # frames sampled evenly over one cardiac cycle
+n_slices = 19
+size = 256                      # in-plane voxels
+spacing = (1.5, 1.5, 8.0)       # x, y, slice spacing in mm
+frame_block = 4                 # frames rasterized together (bounds temporary memory)
+encoding = "gzip"
+compression_level = 1
+
+# Label of each of the blender HEART_COMPONENTS in the segmentations (0 is background)
+LABELS = {"m": 1, "lv": 2, "rv": 3, "la": 4, "ra": 5, "a": 6, "pa": 7, "svc": 8}
+
+# anim_data.csv columns, as in blender/init_anim.py
+START_FRAME_INDEX = 3
+COMPONENT_COLUMNS = {"m": 4, "lv": 4, "rv": 5, "la": 6, "ra": 7, "a": 8, "pa": 9, "svc": 10}
+
+# Chamber semi-axis ratios along (long axis, right, anterior), vessel radii (mm) and mean intensities per label
+CHAMBER_RATIOS = {"m": (1.8, 1.0, 1.0), "lv": (1.8, 1.0, 1.0), "rv": (1.5, 1.1, 0.7), "la": (1.0, 1.0, 1.0), "ra": (1.1, 1.0, 1.0)}
+VESSEL_RADII = {"a": 13.0, "pa": 12.0, "svc": 9.0}
+MYOCARDIUM_ML = (110.0, 15.0)   # mean and SD of the myocardial wall volume, which does not change over the cycle
+INTENSITIES = np.array([0, 90, 420, 400, 380, 370, 440, 430, 360], dtype=np.float32)
+TORSO_INTENSITY = 120.0
+NOISE_SD = 18.0
+
+
+def load_anim_data(path: str) -> tuple[dict, dict, int]:
+    """Read anim_data.csv into per-component volume curves, chamber volume SD ratios and the frame count.
+
+    Curves are the same cubic fits over the phase start frames that blender/init_anim.py keyframes."""
+    rows, sd_ratios, frame_count = [], {}, -1
+    sd_names = {"Left Ventricle": "lv", "Right Ventricle": "rv", "Left Atrium": "la", "Right Atrium": "ra"}
+    with open(path, newline="\n") as csvfile:
+        read_row = False
+        for row in csv.reader(csvfile, delimiter=","):
+            # Skip empty rows
+            if not row or row[0] == "":
+                read_row = False
+                continue
+            if row[0] == "frame count":
+                frame_count = int(row[1])
+            elif row[0] in sd_names:
+                # Spread of the larger (diastole / max) volume
+                sd_ratios[sd_names[row[0]]] = float(row[5]) / float(row[2])
+            elif "Phase" in row[0]:
+                read_row = True
+            elif read_row:
+                rows.append(row)
+
+    x = np.array([float(row[START_FRAME_INDEX]) for row in rows])
+    curves = {component: np.poly1d(np.polyfit(x, [float(row[column]) for row in rows], 3))
+              for component, column in COMPONENT_COLUMNS.items()}
+    return curves, sd_ratios, frame_count
+
+
+def cycle_values(curves: dict, frame_count: int, n_frames=n_frames) -> dict:
+    """Each component's curve sampled at n_frames evenly spaced points of the cycle."""
+    frames = np.linspace(0, frame_count, n_frames, endpoint=False)
+    return {component: curve(frames) for component, curve in curves.items()}
+
+
+def _unit(v) -> np.ndarray:
+    v = np.asarray(v, dtype=np.float64)
+    return v / np.linalg.norm(v)
+
+
+def _box(lo, hi, coords) -> tuple:
+    # Grid index ranges (z, y, x) covering [lo, hi], given as physical (x, y, z)
+    x, y, z = (slice(np.searchsorted(c, l), np.searchsorted(c, h, side="right")) for c, l, h in zip(coords, lo, hi))
+    return z, y, x
+
+
+def _offsets(coords, box, points) -> list[np.ndarray]:
+    # Per-frame (frame, z, y, x) offsets of the boxed grid from points (frame, 3), one array per physical axis
+    z, y, x = box
+    return [coords[0][x][None, None, None, :] - points[:, 0, None, None, None],
+            coords[1][y][None, None, :, None] - points[:, 1, None, None, None],
+            coords[2][z][None, :, None, None] - points[:, 2, None, None, None]]
+
+
+def paint_ellipsoid(labels, label, coords, center, rotation, semi_axes):
+    """Set label inside an ellipsoid for a block of (frame, z, y, x) labels; center and semi_axes are (frame, 3)."""
+    reach = semi_axes.max(axis=1, keepdims=True)
+    box = _box((center - reach).min(axis=0), (center + reach).max(axis=0), coords)
+    d = _offsets(coords, box, center)
+    inside = 0
+    for axis in range(3):
+        local = d[0] * rotation[0, axis] + d[1] * rotation[1, axis] + d[2] * rotation[2, axis]
+        inside = inside + (local / semi_axes[:, axis, None, None, None]) ** 2
+    labels[(slice(None), *box)][inside <= 1] = label
+
+
+def paint_segment(labels, label, coords, start, end, radius):
+    """Set label within radius (frame,) of the segments start -> end (frame, 3), i.e. a capped cylinder."""
+    reach = radius[:, None]
+    box = _box(np.minimum(start, end).min(axis=0) - reach.max(), np.maximum(start, end).max(axis=0) + reach.max(), coords)
+    d = _offsets(coords, box, start)
+    direction = (end - start)[:, :, None, None, None]
+    t = (d[0] * direction[:, 0] + d[1] * direction[:, 1] + d[2] * direction[:, 2]) / (direction ** 2).sum(axis=1)
+    t = np.clip(t, 0, 1)
+    distance = sum((d[axis] - t * direction[:, axis]) ** 2 for axis in range(3))
+    labels[(slice(None), *box)][distance <= radius[:, None, None, None] ** 2] = label
+
+
+def case_shapes(values: dict, sd_ratios: dict, rng) -> list[tuple]:
+    """Draw one case's anatomy: (label, kind, per-frame parameters...) in painting order.
+
+    Chamber sizes follow the sampled volume curves, scaled per case by the population SDs in anim_data.csv."""
+    # Heart position and orientation (long axis runs from the base towards the apex)
+    center = rng.normal(0, (10, 10, 5))
+    long_axis = _unit(np.array([0.5, -0.5, -0.7]) + rng.normal(0, 0.1, 3))
+    right = _unit(np.cross(long_axis, [0, 0, 1]))
+    rotation = np.stack((long_axis, right, np.cross(long_axis, right)), axis=1)
+
+    def semi_axes(component, volume_ml):
+        # Semi-axes (frame, 3) of an ellipsoid with the given volumes and the component's axis ratios
+        ratios = np.asarray(CHAMBER_RATIOS[component])
+        r = np.cbrt(3 * volume_ml[:, None] * 1000 / (4 * np.pi * ratios.prod()))
+        return r * ratios
+
+    scale = {component: np.clip(rng.normal(1, sd_ratios.get(component, 0.1)), 0.6, 1.4) for component in values}
+    volumes = {component: values[component] * scale[component] for component in values}
+    volumes["m"] = volumes["lv"] + max(rng.normal(*MYOCARDIUM_ML), 40)
+    axes = {component: semi_axes(component, volumes[component]) for component in CHAMBER_RATIOS}
+    n = len(values["lv"])
+
+    # Place the other chambers around the ventricle, frame by frame, so they track its size
+    outer = axes["m"]
+    lv_center = np.tile(center, (n, 1))
+    rv_center = lv_center + right * (outer[:, 1] + 0.3 * axes["rv"][:, 1])[:, None] - long_axis * (0.1 * outer[:, :1])
+    la_center = lv_center - long_axis * (outer[:, :1] + 0.8 * axes["la"][:, :1]) - right * (0.3 * outer[:, 1:2])
+    ra_center = rv_center - long_axis * (0.8 * axes["rv"][:, :1] + 0.8 * axes["ra"][:, :1]) + right * (0.4 * axes["ra"][:, 1:2])
+
+    # Vessels leave the base; their CSV columns are multipliers on the mean radius
+    superior = np.array([0.0, 0.0, 1.0])
+    radius = {component: VESSEL_RADII[component] * values[component] / values[component].mean() * np.sqrt(scale["lv"])
+              for component in VESSEL_RADII}
+    a_start = lv_center - long_axis * (0.8 * outer[:, :1])
+    pa_start = rv_center - long_axis * (0.8 * axes["rv"][:, :1])
+    svc_start = ra_center
+
+    return [
+        (LABELS["la"], "ellipsoid", la_center, rotation, axes["la"]),
+        (LABELS["ra"], "ellipsoid", ra_center, rotation, axes["ra"]),
+        (LABELS["rv"], "ellipsoid", rv_center, rotation, axes["rv"]),
+        (LABELS["svc"], "segment", svc_start, svc_start + 70 * superior, radius["svc"]),
+        (LABELS["pa"], "segment", pa_start, pa_start + 50 * _unit(superior - long_axis), radius["pa"]),
+        (LABELS["a"], "segment", a_start, a_start + 60 * _unit(superior - long_axis + 0.5 * right), radius["a"]),
+        # The myocardium shell, then the blood pool it encloses, cut the septum out of the right ventricle
+        (LABELS["m"], "ellipsoid", lv_center, rotation, axes["m"]),
+        (LABELS["lv"], "ellipsoid", lv_center, rotation, axes["lv"]),
+    ]
+
+
+def synthesize_intensities(labels: np.ndarray, spacing=spacing, rng=None) -> np.ndarray:
+    """Simple MR-like int16 intensities for (frame, slice, y, x) labels: jittered per-label means inside an
+    elliptical torso centred in the grid, plus Gaussian noise."""
+    rng = np.random.default_rng(rng)
+    x = (np.arange(labels.shape[3]) - (labels.shape[3] - 1) / 2) * spacing[0]
+    y = (np.arange(labels.shape[2]) - (labels.shape[2] - 1) / 2) * spacing[1]
+    torso = (((x[None, :] / 170) ** 2 + (y[:, None] / 120) ** 2 <= 1) * TORSO_INTENSITY).astype(np.float32)
+    intensities = INTENSITIES * rng.normal(1, 0.1, len(INTENSITIES)).astype(np.float32)
+
+    # Work through the frames in blocks to bound the float temporaries
+    volume = np.empty(labels.shape, dtype=np.int16)
+    noise = np.empty((frame_block, *labels.shape[1:]), dtype=np.float32)
+    for start in range(0, len(labels), frame_block):
+        block = slice(start, min(start + frame_block, len(labels)))
+        block_noise = noise[:block.stop - block.start]
+        rng.standard_normal(dtype=np.float32, out=block_noise)
+        block_noise *= NOISE_SD
+        block_noise += np.where(labels[block] > 0, intensities[labels[block]], torso)
+        np.clip(block_noise, 0, None, out=block_noise)
+        volume[block] = block_noise
+    return volume
+
+
+def write_case(path_prefix: str, volume: np.ndarray, labels: np.ndarray, spacing=spacing, origin=None):
+    """Write (frame, slice, y, x) arrays as {path_prefix}_vol.nrrd / _seg.nrrd in the layout the loaders expect."""
+    header = {
+        "space": "left-posterior-superior",
+        "space directions": [[spacing[0], 0, 0], [0, spacing[1], 0], [0, 0, spacing[2]], [np.nan] * 3],
+        "encoding": encoding,
+    }
+    if origin is not None:
+        header["space origin"] = [float(o) for o in origin]
+
+    # nrrds are stored (x, y, slice, frame), which is the transpose of the arrays built here. Write under temporary
+    # names first so a resumed run never sees half-written cases
+    for suffix, data in (("_seg", labels), ("_vol", volume)):
+        nrrd.write(f"{path_prefix}{suffix}.tmp.nrrd", data.T, header, compression_level=compression_level)
+        os.replace(f"{path_prefix}{suffix}.tmp.nrrd", f"{path_prefix}{suffix}.nrrd")
+
+
+def case_exists(path_prefix: str) -> bool:
+    return os.path.exists(f"{path_prefix}_vol.nrrd") and os.path.exists(f"{path_prefix}_seg.nrrd")
+
+
+def generate_case(path_prefix: str, case_seed, values: dict, sd_ratios: dict) -> str:
+    """Rasterize one phantom case and write it as {path_prefix}_vol.nrrd / _seg.nrrd."""
+    rng = np.random.default_rng(case_seed)
+    n = len(values["lv"])
+    coords = [((np.arange(count) - (count - 1) / 2) * step).astype(np.float32)
+              for count, step in zip((size, size, n_slices), spacing)]
+    shapes = case_shapes(values, sd_ratios, rng)
+
+    # Labels are built as (frame, slice, y, x), the order the loaders permute nrrds into
+    labels = np.zeros((n, n_slices, size, size), dtype=np.uint8)
+    for start in range(0, n, frame_block):
+        block = slice(start, min(start + frame_block, n))
+        for label, kind, first, second, third in shapes:
+            if kind == "ellipsoid":
+                paint_ellipsoid(labels[block], label, coords, first[block].astype(np.float32),
+                                second.astype(np.float32), third[block].astype(np.float32))
+            else:
+                paint_segment(labels[block], label, coords, first[block].astype(np.float32),
+                              second[block].astype(np.float32), third[block].astype(np.float32))
+
+    write_case(path_prefix, synthesize_intensities(labels, spacing, rng), labels)
+    return path_prefix
+
+
+def main():
+    dataset_dir = os.path.join(out_dir, dataset)
+    os.makedirs(dataset_dir, exist_ok=True)
+    curves, sd_ratios, frame_count = load_anim_data(anim_data_path)
+    values = cycle_values(curves, frame_count)
+
+    # Skip cases that already exist so an interrupted run can be resumed
+    jobs = [(os.path.join(dataset_dir, f"case_{case_i:05d}"), [seed, case_i]) for case_i in range(n_cases)]
+    jobs = [job for job in jobs if not case_exists(job[0])]
+    print(f"Generating {len(jobs)} phantom(s) into '{dataset_dir}'")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(generate_case, prefix, case_seed, values, sd_ratios) for prefix, case_seed in jobs]
+        for future in tqdm(futures, desc="Generating"):
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
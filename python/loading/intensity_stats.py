@@ -0,0 +1,264 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import simulated_nrrd_loader
+
+
+stats_name = "intensity_stats.json"     # cached in the dataset directory, next to its nrrds
+num_workers = os.cpu_count()
+percentiles = (0.5, 1, 50, 99, 99.5)
+float_bins = 4096                       # histogram bins for float (and wide integer) data, over the range of the data
+cache_version = 2                       # bumped whenever the cached partials change shape
+
+# 8- and 16-bit integer volumes get one histogram bin per representable value, so their percentiles are exact. Other
+# dtypes get float_bins bins spanning the values seen, to within a factor of two. The per-case partial results are
+# cached with the stamps of their files, so only new or changed cases are read again.
+
+
+class RunningStats:
+    """Count, mean, sum of squared deviations (m2), min and max, merged with Chan's parallel form of Welford's update."""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min=np.inf, max=-np.inf):
+        self.count, self.mean, self.m2, self.min, self.max = int(count), float(mean), float(m2), float(min), float(max)
+
+    @classmethod
+    def of(cls, values: np.ndarray) -> "RunningStats":
+        if values.size == 0:
+            return cls()
+        mean = values.mean(dtype=np.float64)
+        return cls(values.size, mean, np.square(values - mean, dtype=np.float64).sum(), values.min(), values.max())
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        count = self.count + other.count
+        if other.count > 0:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+            self.count = count
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / self.count if self.count > 0 else float("nan")
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def to_list(self) -> list:
+        return [self.count, self.mean, self.m2, self.min, self.max]
+
+    def summary(self) -> dict:
+        return {"count": self.count, "mean": self.mean, "std": self.std, "min": self.min, "max": self.max}
+
+
+class Histogram:
+    """Bins of width 2 ** exponent, bin i covering [(start + i) * width, (start + i + 1) * width).
+
+    Every histogram of one kind lies on the same grid, so histograms merge exactly. Exact ones (8- and 16-bit integers)
+    hold one bin per representable value. The others start empty and cover whatever values they are given with at most
+    n_bins bins, doubling the bin width (and adding pairs of bins together) whenever the range outgrows them."""
+
+    def __init__(self, n_bins: int, exact=False, start=0, exponent=0, counts=None):
+        self.n_bins, self.exact, self.start, self.exponent = n_bins, exact, int(start), int(exponent)
+        self.counts = np.zeros(n_bins, dtype=np.int64) if counts is None else counts
+
+    @classmethod
+    def for_dtype(cls, dtype) -> "Histogram":
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2:
+            info = np.iinfo(dtype)
+            return cls(int(info.max) - int(info.min) + 1, exact=True, start=int(info.min))
+        return cls(float_bins)
+
+    @property
+    def width(self) -> float:
+        return 2.0 ** self.exponent
+
+    def _fit(self, lo: float, hi: float, exponent=None):
+        """Coarsen the bins (to at least exponent) until they cover [lo, hi] as well as the counts already held."""
+        held = np.flatnonzero(self.counts)
+        if len(held) > 0:
+            lo, hi = min(lo, (self.start + held[0]) * self.width), max(hi, (self.start + held[-1]) * self.width)
+            exponent = self.exponent if exponent is None else max(exponent, self.exponent)
+
+        # Start from the width that spreads the range over the bins, resolving at least 1 in 2**20 of its magnitude
+        span = max(hi - lo, max(abs(lo), abs(hi)) * 2.0 ** -20, np.finfo(np.float64).tiny)
+        fitted = math.ceil(math.log2(span / (self.n_bins - 1)))
+        exponent = fitted if exponent is None else max(exponent, fitted)
+        while math.floor(hi / 2.0 ** exponent) - math.floor(lo / 2.0 ** exponent) >= self.n_bins:
+            exponent += 1
+        if len(held) > 0 and (exponent, math.floor(lo / 2.0 ** exponent)) == (self.exponent, self.start):
+            return
+
+        grid, counts = self._grid(held, exponent), self.counts[held]
+        self.start, self.exponent = math.floor(lo / 2.0 ** exponent), exponent
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self._add(grid, counts)
+
+    def _grid(self, bins: np.ndarray, exponent: int) -> np.ndarray:
+        """Positions (start + bin) of some bins on the grid of a coarser exponent."""
+        return (self.start + bins.astype(np.int64)) >> (exponent - self.exponent)
+
+    def _add(self, grid: np.ndarray, counts: np.ndarray):
+        np.add.at(self.counts, grid - self.start, counts)
+
+    def update(self, values: np.ndarray) -> "Histogram":
+        values = values.ravel()
+        if self.exact:
+            self.counts += np.bincount(values.astype(np.int64) - self.start, minlength=self.n_bins)
+            return self
+
+        # Non-finite values have no bin
+        values = values[np.isfinite(values)].astype(np.float64)
+        if values.size == 0:
+            return self
+        self._fit(float(values.min()), float(values.max()))
+        bins = np.floor(values / self.width).astype(np.int64) - self.start
+        self.counts += np.bincount(np.clip(bins, 0, self.n_bins - 1), minlength=self.n_bins)
+        return self
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        if self.exact or other.exact:
+            if (self.exact, self.start, self.n_bins) != (other.exact, other.start, other.n_bins):
+                raise ValueError("Cannot merge histograms with different bins (mixed dtypes in one dataset?)")
+            self.counts += other.counts
+            return self
+
+        held = np.flatnonzero(other.counts)
+        if len(held) == 0:
+            return self
+        self._fit((other.start + held[0]) * other.width, (other.start + held[-1]) * other.width, other.exponent)
+        self._add(other._grid(held, self.exponent), other.counts[held])
+        return self
+
+    def percentile(self, q: float) -> float:
+        """Value below which q percent of the samples fall: exact for exact histograms, bin centres otherwise."""
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            return float("nan")
+        bin_i = int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+        bin_i = min(bin_i, self.n_bins - 1)
+        return float((self.start + bin_i) * self.width if self.exact else (self.start + bin_i + 0.5) * self.width)
+
+    def to_dict(self) -> dict:
+        # Sparse, since most bins of a 16-bit histogram are empty
+        nonzero = np.flatnonzero(self.counts)
+        return {"n_bins": self.n_bins, "exact": self.exact, "start": self.start, "exponent": self.exponent,
+                "bins": nonzero.tolist(), "counts": self.counts[nonzero].tolist()}
+
+    @classmethod
+    def from_dict(cls, entry: dict) -> "Histogram":
+        counts = np.zeros(entry["n_bins"], dtype=np.int64)
+        counts[entry["bins"]] = entry["counts"]
+        return cls(entry["n_bins"], entry["exact"], entry["start"], entry["exponent"], counts)
+
+
+def label_stats(values: np.ndarray, labels: np.ndarray) -> dict[int, RunningStats]:
+    """RunningStats of the values under each label present, from a few bincounts."""
+    values, labels = values.ravel(), labels.ravel().astype(np.int64)
+    counts = np.bincount(labels)
+    present = np.flatnonzero(counts)
+    means = np.bincount(labels, weights=values)[present] / counts[present]
+    full_means = np.zeros(len(counts))
+    full_means[present] = means
+    m2 = np.bincount(labels, weights=np.square(values - full_means[labels]))[present]
+    out = {}
+    for label, count, mean, label_m2 in zip(present, counts[present], means, m2):
+        selected = values[labels == label]
+        out[int(label)] = RunningStats(count, mean, label_m2, selected.min(), selected.max())
+    return out
+
+
+def case_stats(vol_path: str) -> dict:
+    """One pass over a case, a frame at a time: overall and per-label RunningStats plus a histogram."""
+    seg_path = vol_path.replace("_vol", "_seg")
+    header, data_offset = simulated_nrrd_loader.read_header(vol_path)
+    overall = RunningStats()
+    histogram = Histogram.for_dtype(simulated_nrrd_loader.header_dtype(header))
+    labels = {}
+    frames = zip(simulated_nrrd_loader.iter_file_frames(vol_path, header, data_offset),
+                 simulated_nrrd_loader.iter_file_frames(seg_path))
+    for image, mask in frames:
+        image = np.asarray(image)
+        overall.merge(RunningStats.of(image))
+        histogram.update(image)
+        for label, stats in label_stats(image.astype(np.float64), np.asarray(mask)).items():
+            labels.setdefault(label, RunningStats()).merge(stats)
+    return {"stamp": [_stamp(vol_path), _stamp(seg_path)], "overall": overall.to_list(),
+            "labels": {label: stats.to_list() for label, stats in labels.items()}, "histogram": histogram.to_dict()}
+
+
+def _stamp(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def merge(partials) -> tuple[RunningStats, dict[int, RunningStats], Histogram]:
+    overall, labels, histogram = RunningStats(), {}, None
+    for partial in partials:
+        overall.merge(RunningStats(*partial["overall"]))
+        for label, values in partial["labels"].items():
+            labels.setdefault(int(label), RunningStats()).merge(RunningStats(*values))
+        case_histogram = Histogram.from_dict(partial["histogram"])
+        histogram = case_histogram if histogram is None else histogram.merge(case_histogram)
+    return overall, labels, histogram
+
+
+def dataset_stats(dataset: str) -> dict:
+    """Intensity statistics of a whole dataset, computing only the cases missing from (or stale in) its cache."""
+    vol_paths = simulated_nrrd_loader.get_dataset_paths([dataset])
+    cache_path = os.path.join(os.path.dirname(vol_paths[0]), stats_name) if vol_paths else None
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        # Partials of an older layout are recomputed
+        if cached.get("version") == cache_version:
+            cache = cached["cases"]
+
+    names = {path: os.path.basename(path)[:-len("_vol.nrrd")] for path in vol_paths}
+    jobs = [path for path in vol_paths if cache.get(names[path], {}).get("stamp") !=
+            [_stamp(path), _stamp(path.replace("_vol", "_seg"))]]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(case_stats, jobs) if jobs else []
+        for path, partial in tqdm(zip(jobs, results), total=len(jobs), desc=f"Intensity stats of {dataset}"):
+            cache[names[path]] = partial
+    cases = {names[path]: cache[names[path]] for path in vol_paths}
+
+    overall, labels, histogram = merge(cases.values())
+    stats = overall.summary() | {
+        "percentiles": {str(q): histogram.percentile(q) for q in percentiles} if histogram is not None else {},
+        "labels": {str(label): entry.summary() for label, entry in sorted(labels.items())},
+    }
+    if jobs or len(cases) != len(cache):
+        with open(f"{cache_path}.tmp", "w") as f:
+            json.dump({"version": cache_version, "summary": stats, "cases": cases}, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return stats
+
+
+def intensity_range(stats: dict, low=0.5, high=99.5) -> tuple[float, float]:
+    """(lo, hi) intensity window between two of the cached percentiles, e.g. for a global 8-bit conversion."""
+    return stats["percentiles"][str(low)], stats["percentiles"][str(high)]
+
+
+def standardize(volumes: list[torch.Tensor], stats: dict) -> list[torch.Tensor]:
+    """Volumes as float32 with the dataset mean removed and scaled to unit standard deviation."""
+    return [(volume.float() - stats["mean"]) / stats["std"] for volume in volumes]
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    for dataset in active_datasets:
+        stats = dataset_stats(dataset)
+        print(f"{dataset}: mean {stats['mean']:.1f}, std {stats['std']:.1f}, range [{stats['min']:g}, {stats['max']:g}]")
+        print("  percentiles: " + ", ".join(f"{q}%: {value:g}" for q, value in stats["percentiles"].items()))
+        for label, entry in stats["labels"].items():
+            print(f"  label {label}: {entry['count']} voxels, mean {entry['mean']:.1f}, std {entry['std']:.1f}")
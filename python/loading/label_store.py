@@ -0,0 +1,178 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import nrrd_cache
+import simulated_nrrd_loader
+
+
+store_dir = f"{Path('./').parent.absolute()}/data/labels"
+num_workers = os.cpu_count()
+
+# Each case is a flat .lbl of back-to-back encoded (frame, slice) masks plus a .lbl.json giving every slice's codec,
+# offset and run count. As with slice_shards, the index is written last so an unfinished case is never read.
+data_ext = ".lbl"
+index_ext = ".lbl.json"
+
+# A slice is stored either 4-bit packed (two labels per byte, for labels below 16) or run-length encoded as the
+# run values (uint8) followed by the run starts (uint16, or uint32 for slices over 65536 voxels) - whichever is smaller
+PACKED, RLE = 0, 1
+
+
+def _starts_dtype(n_voxels: int) -> np.dtype:
+    return np.dtype("<u2") if n_voxels <= 1 << 16 else np.dtype("<u4")
+
+
+def encode_slice(mask: np.ndarray) -> tuple[int, int, bytes]:
+    """(codec, run count, encoded bytes) of one 2-D mask."""
+    flat = np.ascontiguousarray(mask, dtype=np.uint8).ravel()
+    starts = np.flatnonzero(np.diff(flat, prepend=np.int16(-1)) != 0)
+    rle_bytes = len(starts) * (1 + _starts_dtype(flat.size).itemsize)
+    if flat.max(initial=0) >= 16 or rle_bytes <= (flat.size + 1) // 2:
+        return RLE, len(starts), flat[starts].tobytes() + starts.astype(_starts_dtype(flat.size)).tobytes()
+    padded = np.resize(flat, flat.size + flat.size % 2) if flat.size % 2 else flat
+    return PACKED, 0, ((padded[0::2] << 4) | padded[1::2]).tobytes()
+
+
+def write_labels(path: str, seg_path: str, reorder=(3, 2, 1, 0)) -> dict:
+    """Encode every (frame, slice) mask of a segmentation nrrd into {path}.lbl, streaming one frame at a time.
+
+    Slices are laid out as in the loaders' reordered (frame, slice, a, b) tensors; reorder must lead with the frame axis."""
+    if reorder[0] != 3:
+        raise ValueError(f"The label store needs the frame axis first, got reorder={reorder}")
+    frame_axes = tuple(reorder[1:])
+    header, data_offset = simulated_nrrd_loader.read_header(seg_path)
+    sizes = [int(size) for size in header["sizes"]]
+    shape = [sizes[3] if len(sizes) == 4 else 1] + [sizes[axis] for axis in frame_axes]
+
+    codecs, offsets, runs = [], [], []
+    offset = 0
+    with open(f"{path}{data_ext}.tmp", "wb") as fh:
+        for frame in simulated_nrrd_loader.iter_file_frames(seg_path, header, data_offset):
+            for mask in np.transpose(frame, frame_axes):
+                codec, n_runs, data = encode_slice(mask)
+                fh.write(data)
+                codecs.append(codec)
+                offsets.append(offset)
+                runs.append(n_runs)
+                offset += len(data)
+    os.replace(f"{path}{data_ext}.tmp", f"{path}{data_ext}")
+
+    index = {"source": nrrd_cache.source_key(seg_path, reorder, np.uint8), "shape": shape,
+             "codecs": codecs, "offsets": offsets, "runs": runs}
+    with open(f"{path}{index_ext}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{path}{index_ext}.tmp", f"{path}{index_ext}")
+    return index
+
+
+class LabelReader:
+    """Random (frame, slice) access to one encoded case, decoding only the requested slices."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(f"{path}{index_ext}") as f:
+            index = json.load(f)
+        self.source = index["source"]
+        self.shape = tuple(index["shape"])
+        self.codecs = np.asarray(index["codecs"], dtype=np.uint8)
+        self.offsets = np.asarray(index["offsets"], dtype=np.int64)
+        self.runs = np.asarray(index["runs"], dtype=np.int64)
+        self.slice_voxels = self.shape[2] * self.shape[3]
+        self.starts_dtype = _starts_dtype(self.slice_voxels)
+
+        # Empty files cannot be mapped
+        data_path = f"{path}{data_ext}"
+        self.buffer = np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path) else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.codecs)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.buffer)
+
+    def read(self, indices, dtype=np.uint8) -> np.ndarray:
+        """Decode the masks at flat (frame * n_slices + slice) indices into an (n, a, b) array, one vectorized
+        gather per codec."""
+        indices = np.atleast_1d(np.asarray(indices, dtype=np.int64))
+        out = np.empty((len(indices), self.slice_voxels), dtype=dtype)
+
+        packed = np.flatnonzero(self.codecs[indices] == PACKED)
+        if len(packed) > 0:
+            n_bytes = (self.slice_voxels + 1) // 2
+            data = self.buffer[self.offsets[indices[packed]][:, None] + np.arange(n_bytes)]
+            unpacked = np.empty((len(packed), 2 * n_bytes), dtype=np.uint8)
+            unpacked[:, 0::2] = data >> 4
+            unpacked[:, 1::2] = data & 15
+            out[packed] = unpacked[:, :self.slice_voxels]
+
+        rle = np.flatnonzero(self.codecs[indices] == RLE)
+        if len(rle) > 0:
+            # Gather the value and start bytes of every run of every requested slice
+            offsets, runs = self.offsets[indices[rle]], self.runs[indices[rle]]
+            run_i = np.arange(runs.sum()) - np.repeat(np.cumsum(runs) - runs, runs)
+            values = self.buffer[np.repeat(offsets, runs) + run_i]
+            start_at = np.repeat(offsets + runs, runs) + run_i * self.starts_dtype.itemsize
+            start_bytes = self.buffer[start_at[:, None] + np.arange(self.starts_dtype.itemsize)]
+            starts = start_bytes.copy().view(self.starts_dtype).ravel().astype(np.int64)
+
+            # Runs end where the next one starts, or at the end of their slice
+            ends = np.append(starts[1:], self.slice_voxels)
+            ends[np.cumsum(runs) - 1] = self.slice_voxels
+            out[rle] = np.repeat(values, ends - starts).reshape(len(rle), self.slice_voxels)
+        return out.reshape(len(indices), *self.shape[2:])
+
+    def slice(self, frame_i: int, slice_i: int, dtype=np.uint8) -> np.ndarray:
+        return self.read(frame_i * self.shape[1] + slice_i, dtype)[0]
+
+    def volume(self, dtype=np.uint8) -> np.ndarray:
+        return self.read(np.arange(len(self)), dtype).reshape(self.shape)
+
+    def tensor(self, dtype=torch.int64) -> torch.Tensor:
+        """The whole case as a (frame, slice, a, b) tensor, e.g. int64 class indices for a loss."""
+        return torch.from_numpy(self.volume()).to(dtype)
+
+
+def case_path(dataset: str, seg_path: str) -> str:
+    return os.path.join(store_dir, dataset, os.path.basename(seg_path)[:-len(".nrrd")])
+
+
+def is_current(path: str, seg_path: str, reorder) -> bool:
+    if not os.path.exists(f"{path}{index_ext}"):
+        return False
+    with open(f"{path}{index_ext}") as f:
+        return json.load(f)["source"] == nrrd_cache.source_key(seg_path, reorder, np.uint8)
+
+
+def compile_dataset(dataset: str, reorder=(3, 2, 1, 0)) -> list[str]:
+    """Encode every segmentation of a dataset into the store, skipping cases whose source is unchanged."""
+    seg_paths = [path.replace("_vol", "_seg") for path in simulated_nrrd_loader.get_dataset_paths([dataset])]
+    os.makedirs(os.path.join(store_dir, dataset), exist_ok=True)
+    jobs = [(case_path(dataset, seg_path), seg_path) for seg_path in seg_paths
+            if not is_current(case_path(dataset, seg_path), seg_path, reorder)]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(write_labels, path, seg_path, reorder) for path, seg_path in jobs]
+        for future in tqdm(futures, desc=f"Encoding {dataset} labels"):
+            future.result()
+    return [case_path(dataset, seg_path) for seg_path in seg_paths]
+
+
+def open_dataset(dataset: str, reorder=(3, 2, 1, 0)) -> list[LabelReader]:
+    """Readers for every case of a dataset, in get_dataset_paths order, encoding any that are missing or stale."""
+    return [LabelReader(path) for path in compile_dataset(dataset, reorder)]
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    for dataset in active_datasets:
+        readers = open_dataset(dataset)
+        stored = sum(reader.nbytes for reader in readers)
+        full = sum(int(np.prod(reader.shape)) for reader in readers)
+        print(f"{dataset}: {len(readers)} case(s), {stored / 1e6:.1f} MB encoded vs {full / 1e6:.1f} MB as uint8 "
+              f"({full / max(stored, 1):.0f}x)")
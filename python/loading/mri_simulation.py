@@ -0,0 +1,144 @@
+from pathlib import Path
+import os
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nrrd
+from tqdm import tqdm
+
+import generate_phantoms
+import simulated_nrrd_loader
+
+
+in_dir = f"{Path('./').parent.absolute()}/data/unprocessed"
+dataset = "19x256"
+variant = "bssfp_r2"            # written to data/unprocessed/{dataset}_{variant}
+num_workers = os.cpu_count()
+seed = 0
+
+# Sequence and acquisition
+sequence = "bssfp"              # "bssfp" (cine) or "gre" (spoiled gradient echo)
+flip_angle = 50.0               # degrees
+tr = 3.0                        # ms
+te = 1.5                        # ms
+n_coils = 4
+noise_sd = 0.02                 # complex noise per coil, relative to the brightest tissue
+acceleration = 2                # keep every n-th phase-encode line on average (1 = fully sampled)
+center_fraction = 0.08          # fraction of central k-space lines that are always kept
+intensity_scale = 1000          # brightest tissue maps to roughly this int16 value
+chunk_bytes = 256 * 1024**2     # bound on the complex coil images transformed in one batch
+
+# Proton density and T1/T2 (ms, ~1.5 T) of each label's tissue. Label 0 carries no tissue in the segmentations
+MYOCARDIUM = (0.8, 1030.0, 40.0)
+BLOOD = (0.95, 1550.0, 250.0)
+TISSUES = {0: (0.0, 1000.0, 50.0), generate_phantoms.LABELS["m"]: MYOCARDIUM,
+           **{generate_phantoms.LABELS[c]: BLOOD for c in ("lv", "rv", "la", "ra", "a", "pa", "svc")}}
+
+
+def tissue_signal(sequence=sequence, flip_angle=flip_angle, tr=tr, te=te, tissues=TISSUES) -> np.ndarray:
+    """Steady-state signal of every label's tissue, as a lookup table indexed by label."""
+    pd, t1, t2 = (np.array([tissues.get(label, tissues[0])[i] for label in range(generate_phantoms.INTENSITIES.size)])
+                  for i in range(3))
+    alpha = np.deg2rad(flip_angle)
+    if sequence == "bssfp":
+        # On-resonance balanced SSFP
+        signal = pd * np.sin(alpha) / ((t1 / t2 + 1) - np.cos(alpha) * (t1 / t2 - 1)) * np.exp(-te / t2)
+    elif sequence == "gre":
+        e1 = np.exp(-tr / t1)
+        signal = pd * np.sin(alpha) * (1 - e1) / (1 - np.cos(alpha) * e1) * np.exp(-te / t2)
+    else:
+        raise ValueError(f"Unknown sequence: \"{sequence}\"")
+    return (signal / signal.max()).astype(np.float32)
+
+
+def coil_sensitivities(shape, n_coils=n_coils) -> np.ndarray:
+    """Smooth complex (coil, y, x) sensitivities of coils spaced evenly around the field of view."""
+    y, x = np.meshgrid(np.linspace(-1, 1, shape[0]), np.linspace(-1, 1, shape[1]), indexing="ij")
+    angles = 2 * np.pi * np.arange(n_coils) / n_coils
+    distance = (y[None] - 1.2 * np.sin(angles)[:, None, None]) ** 2 + (x[None] - 1.2 * np.cos(angles)[:, None, None]) ** 2
+    return (np.exp(-distance / 1.5) * np.exp(1j * angles[:, None, None])).astype(np.complex64)
+
+
+def undersampling_mask(n_images, n_lines, acceleration=acceleration, center_fraction=center_fraction, rng=None) -> np.ndarray:
+    """Random Cartesian phase-encode masks (image, line), in unshifted FFT order, with the centre always kept."""
+    rng = np.random.default_rng(rng)
+    if acceleration <= 1:
+        return np.ones((n_images, n_lines), dtype=bool)
+    n_center = int(round(n_lines * center_fraction))
+    center = np.abs(np.arange(n_lines) - n_lines // 2) < n_center / 2
+    keep = max((n_lines / acceleration - n_center) / max(n_lines - n_center, 1), 0)
+    mask = center[None] | (rng.random((n_images, n_lines)) < keep)
+    return np.fft.ifftshift(mask, axes=-1)
+
+
+def simulate(labels: np.ndarray, lut=None, sensitivities=None, rng=None) -> np.ndarray:
+    """MR magnitude images for labels of any shape ending in (y, x).
+
+    Every image is multiplied by the coil sensitivities, transformed to k-space, given complex noise and
+    undersampled along y, then reconstructed zero-filled with a root-sum-of-squares coil combine. All images in a
+    chunk go through one batched FFT."""
+    rng = np.random.default_rng(rng)
+    lut = tissue_signal() if lut is None else lut
+    shape = labels.shape
+    images = labels.reshape(-1, *shape[-2:])
+    sensitivities = coil_sensitivities(shape[-2:]) if sensitivities is None else sensitivities
+    out = np.empty(images.shape, dtype=np.float32)
+
+    # Several complex temporaries of (batch, coil, y, x) are alive at once
+    batch = max(chunk_bytes // (3 * sensitivities.nbytes), 1)
+    for start in range(0, len(images), batch):
+        chunk = slice(start, min(start + batch, len(images)))
+        coil_images = np.take(lut, images[chunk], mode="clip")[:, None] * sensitivities[None]
+        kspace = np.fft.fft2(coil_images, norm="ortho")
+        noise = rng.standard_normal((2, *kspace.shape), dtype=np.float32) * np.float32(noise_sd / np.sqrt(2))
+        kspace += noise[0] + 1j * noise[1]
+        kspace *= undersampling_mask(len(kspace), shape[-2], rng=rng)[:, None, :, None]
+        coil_images = np.fft.ifft2(kspace, norm="ortho")
+        out[chunk] = np.sqrt((np.abs(coil_images) ** 2).sum(axis=1))
+    return out.reshape(shape)
+
+
+def simulate_case(seg_path: str, out_prefix: str, case_seed) -> str:
+    """Write a simulated {out_prefix}_vol.nrrd for one segmentation, alongside a link to (or copy of) the segmentation."""
+    # The volume is written last, since its presence marks the case as done
+    seg_out = f"{out_prefix}_seg.nrrd"
+    if not os.path.exists(seg_out):
+        try:
+            os.link(seg_path, seg_out)
+        except OSError:
+            shutil.copyfile(seg_path, seg_out)
+
+    header, data_offset = simulated_nrrd_loader.read_header(seg_path)
+    # (x, y, slice, frame) on disk, so the transpose is (frame, slice, y, x) with images on the last two axes
+    labels = np.asarray(simulated_nrrd_loader.map_file_as_np(seg_path, header, data_offset)).T
+    volume = simulate(labels, rng=case_seed) * intensity_scale
+    volume = np.clip(volume, 0, np.iinfo(np.int16).max).astype(np.int16)
+
+    # Keep the segmentation's geometry fields; pynrrd fills in type, sizes and encoding details
+    vol_header = {key: value for key, value in header.items()
+                  if key not in ("type", "dimension", "sizes", "endian", "encoding", "data file", "datafile")}
+    vol_header["encoding"] = generate_phantoms.encoding
+    nrrd.write(f"{out_prefix}_vol.tmp.nrrd", volume.T, vol_header, compression_level=generate_phantoms.compression_level)
+    os.replace(f"{out_prefix}_vol.tmp.nrrd", f"{out_prefix}_vol.nrrd")
+    return out_prefix
+
+
+def main():
+    out_dir = os.path.join(in_dir, f"{dataset}_{variant}")
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for vol_path in simulated_nrrd_loader.get_dataset_paths([dataset]):
+        name = os.path.basename(vol_path)[:-len("_vol.nrrd")]
+        if not os.path.exists(os.path.join(out_dir, f"{name}_vol.nrrd")):
+            jobs.append((vol_path.replace("_vol", "_seg"), os.path.join(out_dir, name), [seed, zlib.crc32(name.encode())]))
+    print(f"Simulating {len(jobs)} {sequence} volume(s) from '{dataset}' into '{out_dir}'")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(simulate_case, *job) for job in jobs]
+        for future in tqdm(futures, desc="Simulating"):
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import simulated_nrrd_loader
+
+
+cache_dir = f"{Path('./').parent.absolute()}/data/cache"
+index_name = "index.json"
+
+
+def source_key(path: str, reorder, dtype) -> dict:
+    """Identify a cache entry by its source file and the layout it was compiled to."""
+    stat = os.stat(path)
+    return {
+        "source": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "reorder": list(reorder),
+        "dtype": np.dtype(dtype).str,
+    }
+
+
+def load_index(dataset: str) -> dict:
+    index_path = os.path.join(cache_dir, dataset, index_name)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def save_index(dataset: str, index: dict):
+    # Write to a temporary file first so an interrupted compile never leaves a corrupt index. Temporary names are
+    # per process, as every rank of a distributed run compiles (and saves) the same cache
+    index_path = os.path.join(cache_dir, dataset, index_name)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+
+
+def compile_file(src_path: str, out_path: str, reorder, dtype):
+    """Write an nrrd into a contiguous .npy already in the reordered layout and target dtype."""
+    # Raw sources are mapped; compressed ones are decoded once into a fresh buffer
+    header, data_offset = simulated_nrrd_loader.read_header(src_path)
+    if simulated_nrrd_loader.is_streamable(header):
+        arr = simulated_nrrd_loader.decode_file_as_np(src_path)
+    else:
+        arr = simulated_nrrd_loader.map_file_as_np(src_path, header, data_offset)
+    arr = np.transpose(arr, reorder)
+
+    # Fill the output map one leading index at a time to keep memory bounded
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=arr.shape)
+    for i in range(len(arr)):
+        out[i] = arr[i]
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+
+
+def compile_dataset(dataset: str, reorder=(3, 2, 1, 0), vol_dtype=np.float32, seg_dtype=np.uint8,
+                    num_threads=os.cpu_count()) -> dict:
+    """Compile every case of a dataset into the cache, rebuilding only entries whose source changed."""
+    vol_paths = simulated_nrrd_loader.get_dataset_paths([dataset])
+    os.makedirs(os.path.join(cache_dir, dataset), exist_ok=True)
+    index = load_index(dataset)
+
+    # Collect entries whose source changed
+    jobs = []
+    for vol_path in vol_paths:
+        for src_path, dtype in ((vol_path, vol_dtype), (vol_path.replace("_vol", "_seg"), seg_dtype)):
+            name = os.path.basename(src_path).replace(".nrrd", ".npy")
+            out_path = os.path.join(cache_dir, dataset, name)
+            key = source_key(src_path, reorder, dtype)
+
+            # Skip entries that are still up to date
+            if index.get(name) == key and os.path.exists(out_path):
+                continue
+            jobs.append((name, key, src_path, out_path, dtype))
+
+    # Decode in threads (zlib releases the GIL), saving the index as entries finish so interrupted compiles resume
+    built = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(compile_file, src_path, out_path, reorder, dtype): (name, key)
+                   for name, key, src_path, out_path, dtype in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Compiling {dataset}"):
+            future.result()
+            name, key = futures[future]
+            index[name] = key
+            built += 1
+            save_index(dataset, index)
+
+    print(f"Compiled {built} file(s) into '{cache_dir}/{dataset}'")
+    return index
+
+
+def load_cached_file(dataset: str, src_path: str, index=None) -> np.ndarray:
+    """Map a compiled cache entry, or return None if it is missing or out of date."""
+    if index is None:
+        index = load_index(dataset)
+    name = os.path.basename(src_path).replace(".nrrd", ".npy")
+    out_path = os.path.join(cache_dir, dataset, name)
+    entry = index.get(name)
+    if entry is None or not os.path.exists(out_path) or entry != source_key(src_path, entry["reorder"], entry["dtype"]):
+        simulated_nrrd_loader.telemetry.count("npy_cache_misses")
+        return None
+    simulated_nrrd_loader.telemetry.count("npy_cache_hits")
+    with simulated_nrrd_loader.telemetry.span("npy_cache_map", src_path) as span:
+        arr = np.load(out_path, mmap_mode="c")
+        span.n_bytes = arr.nbytes
+    return arr
+
+
+def load_cached_case(dataset: str, vol_path: str, index=None) -> tuple[torch.Tensor, torch.Tensor]:
+    """(volume, label) tensors mapped from the cache, raising if either entry is missing or out of date."""
+    out = []
+    for src_path in (vol_path, vol_path.replace("_vol", "_seg")):
+        arr = load_cached_file(dataset, src_path, index)
+        if arr is None:
+            raise simulated_nrrd_loader.DatasetError(f"No up-to-date cache entry for {src_path} in "
+                                                     f"'{cache_dir}/{dataset}' (did it change after compiling?)")
+        out.append(torch.from_numpy(arr))
+    return out[0], out[1]
+
+
+def cached_splits(active_datasets, split=[1.0, 0.0, 0.0], reorder=(3, 2, 1, 0), vol_dtype=np.float32,
+                  seg_dtype=np.uint8, seed=None, strata=None, rank=0, world_size=1, epoch=0) -> list[list[tuple]]:
+    """Bring the caches up to date, then this process's share of each split as (dataset, volume path, index) triples.
+
+    The shared split and shard step of load_cached_tensors and the loaders built on top of the cache."""
+    indexes, datasets = {}, {}
+    for dataset in active_datasets:
+        indexes[dataset] = compile_dataset(dataset, reorder, vol_dtype, seg_dtype)
+        datasets.update((vol_path, dataset) for vol_path in simulated_nrrd_loader.get_dataset_paths([dataset]))
+
+    # Split and shard on paths, so only this process's share is mapped
+    splits = simulated_nrrd_loader.split_and_shard_paths(list(datasets), split, seed, strata, rank, world_size, epoch)
+    return [[(datasets[path], path, indexes[datasets[path]]) for path in paths] for paths in splits]
+
+
+def load_cached_tensors(active_datasets,
+                        split=[1.0, 0.0, 0.0],    # train, validation, test
+                        reorder=(3, 2, 1, 0),
+                        vol_dtype=np.float32,
+                        seg_dtype=np.uint8,
+                        seed=None,
+                        strata=None,
+                        rank=0,
+                        world_size=1,
+                        epoch=0):
+    """Same contract as load_data_as_tensors, but served as zero-copy maps of the compiled cache."""
+    out = []
+    for cases in cached_splits(active_datasets, split, reorder, vol_dtype, seg_dtype, seed, strata, rank, world_size,
+                               epoch):
+        cases = [load_cached_case(dataset, path, index) for dataset, path, index in cases]
+        out.append(([volume for volume, _ in cases], [label for _, label in cases]))
+
+    train_data, validation_data, test_data = out
+    return train_data, validation_data, test_data
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    for dataset in active_datasets:
+        compile_dataset(dataset)
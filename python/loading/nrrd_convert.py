@@ -0,0 +1,245 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+import simulated_nrrd_loader
+import slice_shards
+
+
+manifest_name = "manifest.txt"
+
+
+class SourceAdapter:
+    """Describes how one dataset's files are found, paired and oriented; the engine handles everything else."""
+    frame_axes = None   # transpose of one file frame into (slice, x, y); 4-D files store frames on their last axis
+    flip = ()           # axes of the (slice, x, y) frame to reverse after transposing
+    block_slices = 4    # slices normalized together, bounding the float temporary
+    intensity_range = None  # (lo, hi) window shared by every slice (see intensity_stats), instead of per-slice min/max
+
+    def cases(self) -> list[tuple[str, str, str]]:
+        """List (case name, image path, mask path or None) for every case in the dataset."""
+        raise NotImplementedError
+
+    def normalize(self, frame: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Write a (slice, x, y) image frame into a contiguous uint8 buffer, scaling each slice by its own min/max, or
+        by intensity_range when set (clipping values outside it).
+
+        The frame may be a strided or flipped view of the mapped source; subtract, scale and cast are fused per
+        block of slices so no full-size float copy is ever made."""
+        for start in range(0, len(frame), self.block_slices):
+            block = frame[start:start + self.block_slices]
+            if self.intensity_range is not None:
+                min_vals, max_vals = (np.float64(value) for value in self.intensity_range)
+            else:
+                min_vals = block.min(axis=(-2,-1), keepdims=True)
+                max_vals = block.max(axis=(-2,-1), keepdims=True)
+            with np.errstate(divide='ignore'):
+                scale = np.where(max_vals > min_vals, 255 / (max_vals - min_vals), 0)
+            scaled = np.subtract(block, min_vals, dtype=np.result_type(block, scale))
+            scaled *= scale
+            if self.intensity_range is not None:
+                np.clip(scaled, 0, 255, out=scaled)
+            np.copyto(out[start:start + self.block_slices], scaled, casting="unsafe")
+        return out
+
+    def frames(self, path: str):
+        """Yield each frame of a file oriented as (slice, x, y), without copying when the source is mapped."""
+        for frame in simulated_nrrd_loader.iter_file_frames(path):
+            frame = np.transpose(frame, self.frame_axes)
+            for axis in self.flip:
+                frame = np.flip(frame, axis)
+            yield frame
+
+    def n_frames(self, path: str) -> int:
+        sizes = simulated_nrrd_loader.read_header(path)[0]["sizes"]
+        return int(sizes[-1]) if len(sizes) == 4 else 1
+
+
+class SimulatedAdapter(SourceAdapter):
+    """Unreal scanner output: paired *_vol.nrrd/*_seg.nrrd stored as (x, y, slice, frame) with y flipped."""
+    frame_axes = (2, 0, 1)  # slice, x, y
+    flip = (1,)             # fix flipped y
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+
+    def cases(self):
+        vol_paths = sorted(glob.glob(f"{self.dataset_dir}/*_vol.nrrd"))
+        return [(os.path.basename(path)[:-len("_vol.nrrd")], path, path.replace("_vol.nrrd", "_seg.nrrd"))
+                for path in vol_paths]
+
+
+class UtahMiccaiAdapter(SourceAdapter):
+    """2018 Utah MICCAI atrial challenge: <set>/<patient>/lgemri.nrrd with an optional laendo.nrrd mask."""
+    frame_axes = (2, 1, 0)  # (x, y, slice) source to slice, y, x, as the original converter saved it
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+
+    def cases(self):
+        cases = []
+        for path in sorted(glob.glob(f"{self.dataset_dir}/*/*/lgemri.nrrd")):
+            mask_path = path.replace("lgemri.nrrd", "laendo.nrrd")
+            cases.append((Path(path).parent.name, path, mask_path if os.path.exists(mask_path) else None))
+        return cases
+
+    def normalize(self, frame, out):
+        # Already stored as 8-bit intensities
+        np.copyto(out, frame, casting="unsafe")
+        return out
+
+
+def frame_key(format: str, name: str, frame_i: int) -> str:
+    return f"{format}/{name}/frame_{frame_i}"
+
+
+def load_manifest(manifest_path: str) -> set:
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def convert_case(adapter: SourceAdapter, out_dir: str, name: str, image_path: str, mask_path: str,
+                 frames: list[int], formats: tuple[str]) -> tuple[list[str], int, int]:
+    """Stream the given frames of one case through normalize and out to each format, returning the completed frame keys, slice count and bytes written."""
+    # Ensure out directories are valid
+    if "png" in formats:
+        for type in ("vol", "seg"):
+            os.makedirs(os.path.join(out_dir, type), exist_ok=True)
+    shard_writer = None
+    if "shards" in formats:
+        os.makedirs(os.path.join(out_dir, "shards"), exist_ok=True)
+        shard_writer = slice_shards.ShardWriter(os.path.join(out_dir, "shards", f"{name}_from_frame_{frames[0]}"))
+
+    # Stream image and mask frames together; only one frame of each is materialized at a time
+    image_frames = adapter.frames(image_path)
+    mask_frames = adapter.frames(mask_path) if mask_path is not None else None
+    wanted, last_frame = set(frames), max(frames)
+    image_buffer = None
+    done, n_slices, n_bytes = [], 0, 0
+    for frame_i, image_frame in enumerate(image_frames):
+        if frame_i > last_frame:
+            break
+        mask_frame = next(mask_frames) if mask_frames is not None else None
+        if frame_i not in wanted:
+            continue
+        if image_buffer is None:
+            image_buffer = np.empty(image_frame.shape, dtype=np.uint8)
+        image_frame = adapter.normalize(image_frame, image_buffer)
+        if mask_frame is not None:
+            mask_frame = np.ascontiguousarray(mask_frame)
+
+        for slice_i in range(len(image_frame)):
+            # Save slice in each format
+            slice_name = f"{name}_frame_{frame_i}_slice_{slice_i}"
+            if "png" in formats:
+                for type, frame in (("vol", image_frame), ("seg", mask_frame)):
+                    if frame is None:
+                        continue
+                    out_path = os.path.join(out_dir, type, f"{slice_name}.png")
+                    Image.fromarray(np.ascontiguousarray(frame[slice_i])).save(out_path)
+                    n_bytes += os.path.getsize(out_path)
+            if shard_writer is not None:
+                shard_writer.write(slice_name, image_frame[slice_i], None if mask_frame is None else mask_frame[slice_i])
+            n_slices += 1
+
+        done.extend(frame_key(format, name, frame_i) for format in formats)
+
+    if shard_writer is not None:
+        n_bytes += shard_writer.close()
+
+    return done, n_slices, n_bytes
+
+
+def is_mappable(path: str) -> bool:
+    """Whether the voxels of a file are memory-mapped (see simulated_nrrd_loader.map_file_as_np) rather than decoded."""
+    header = simulated_nrrd_loader.read_header(path)[0]
+    return header["encoding"] == "raw" and header.get("line skip", header.get("lineskip", 0)) == 0
+
+
+def plan(adapter: SourceAdapter, out_dir: str, formats: tuple[str], split_frames: bool) -> list[tuple]:
+    """List the tasks still needed to bring out_dir up to date, grouping frames by the formats they are missing."""
+    completed = load_manifest(os.path.join(out_dir, manifest_name))
+    tasks = []
+    for name, image_path, mask_path in adapter.cases():
+        missing = {}
+        for frame_i in range(adapter.n_frames(image_path)):
+            missing_formats = tuple(format for format in formats if frame_key(format, name, frame_i) not in completed)
+            if len(missing_formats) > 0:
+                missing.setdefault(missing_formats, []).append(frame_i)
+        # Only mapped sources can seek to a frame; compressed ones would be decoded again up to it by every task
+        splittable = split_frames and all(is_mappable(path) for path in (image_path, mask_path) if path is not None)
+        for missing_formats, frames in missing.items():
+            if splittable:
+                tasks.extend((adapter, out_dir, name, image_path, mask_path, [frame_i], missing_formats) for frame_i in frames)
+            else:
+                tasks.append((adapter, out_dir, name, image_path, mask_path, frames, missing_formats))
+    return tasks
+
+
+def run(jobs: list[tuple[SourceAdapter, str]],
+        formats=("png",),
+        num_workers=os.cpu_count(),
+        split_frames=False,
+        max_in_flight=None):
+    """Convert every (adapter, out_dir) job on one shared process pool."""
+    tasks = []
+    for adapter, out_dir in jobs:
+        os.makedirs(out_dir, exist_ok=True)
+        tasks.extend(plan(adapter, out_dir, formats, split_frames))
+    print(f"{len(tasks)} conversion task(s) remaining")
+
+    # Bound the number of submitted tasks so that only a few volumes are resident at once
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    manifests = {out_dir: open(os.path.join(out_dir, manifest_name), "a") for _, out_dir in jobs}
+
+    start = time.perf_counter()
+    total_slices, total_bytes = 0, 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(tasks)) as progress:
+        pending = {}
+        task_iter = iter(tasks)
+        while True:
+            # Top up the in-flight window
+            for task in task_iter:
+                pending[executor.submit(convert_case, *task)] = task[1]
+                if len(pending) >= max_in_flight:
+                    break
+            if len(pending) == 0:
+                break
+
+            # Record finished tasks in their manifest as they complete
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                manifest = manifests[pending.pop(future)]
+                done, n_slices, n_bytes = future.result()
+                manifest.write("".join(f"{key}\n" for key in done))
+                manifest.flush()
+                total_slices += n_slices
+                total_bytes += n_bytes
+                progress.update()
+
+    for manifest in manifests.values():
+        manifest.close()
+
+    # Report throughput
+    elapsed = time.perf_counter() - start
+    if elapsed > 0:
+        print(f"Wrote {total_slices} slices ({total_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: "
+              f"{total_slices / elapsed:.1f} slices/s, {total_bytes / 1e6 / elapsed:.2f} MB/s")
+    return total_slices, total_bytes
+
+
+if __name__ == "__main__":
+    root = Path('./').parent.absolute()
+    out_dir = f"{root}/data/png"
+    run([
+        (SimulatedAdapter(f"{root}/data/unprocessed/19x256"), f"{out_dir}/19x256"),
+        (UtahMiccaiAdapter(f"{root}/data/downloaded/2018_UTAH_MICCAI"), f"{out_dir}/2018_UTAH_MICCAI"),
+    ])
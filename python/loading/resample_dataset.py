@@ -0,0 +1,160 @@
+from pathlib import Path
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nrrd
+from tqdm import tqdm
+
+import generate_phantoms
+import simulated_nrrd_loader
+
+
+in_dir = f"{Path('./').parent.absolute()}/data/unprocessed"
+dataset = "19x256"
+n_slices = 10
+size = 128                      # in-plane voxels (both axes)
+n_frames = None                 # None keeps each case's frame count
+label_mode = "majority"         # "majority" (one-hot vote) or "nearest"
+periodic_frames = True          # frames cover one full cardiac cycle, so interpolate across its wrap-around
+frame_block = 4                 # source frames resampled together (bounds temporary memory)
+num_workers = os.cpu_count()
+
+
+def output_name() -> str:
+    """Target dataset name, following the {slices}x{size} convention, e.g. 19x256 -> 10x128."""
+    return f"{n_slices}x{size}" if n_frames is None else f"{n_slices}x{size}_{n_frames}f"
+
+
+def axis_weights(n_src: int, n_dst: int, periodic=False, nearest=False) -> tuple[np.ndarray, np.ndarray]:
+    """(taps, weights), each (n_dst, k), resampling one axis from n_src to n_dst samples over the same extent.
+
+    A triangle filter is used: plain linear interpolation when upsampling, widened to the source spacing when
+    downsampling so every source sample contributes (antialiasing). nearest picks a single tap instead."""
+    scale = n_src / n_dst
+    centers = np.arange(n_dst) * scale if periodic else (np.arange(n_dst) + 0.5) * scale - 0.5
+    if nearest:
+        taps = np.floor(centers + 0.5).astype(np.int64)[:, None]
+        weights = np.ones(taps.shape, dtype=np.float32)
+    else:
+        support = max(scale, 1.0)
+        first = np.floor(centers - support).astype(np.int64) + 1
+        taps = first[:, None] + np.arange(int(np.ceil(2 * support)) + 1)[None]
+        weights = np.maximum(0, 1 - np.abs(taps - centers[:, None]) / support).astype(np.float32)
+        weights /= weights.sum(axis=1, keepdims=True)
+    taps = taps % n_src if periodic else np.clip(taps, 0, n_src - 1)
+    return taps, weights
+
+
+def resample_axis(data: np.ndarray, axis: int, taps: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Weighted sum of gathered taps along one axis of a float32 array."""
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    out = np.take(data, taps[:, 0], axis=axis) * weights[:, 0].reshape(shape)
+    for k in range(1, taps.shape[1]):
+        out += np.take(data, taps[:, k], axis=axis) * weights[:, k].reshape(shape)
+    return out
+
+
+def resample(data: np.ndarray, shape, nearest=False) -> np.ndarray:
+    """Separably resample a (frame, slice, y, x) array to shape, as float32.
+
+    Spatial axes are done a block of frames at a time and the frame axis last, on the smaller result."""
+    spatial = [axis_weights(n_src, n_dst, nearest=nearest) for n_src, n_dst in zip(data.shape[1:], shape[1:])]
+    out = np.empty((data.shape[0], *shape[1:]), dtype=np.float32)
+    for start in range(0, data.shape[0], frame_block):
+        block = np.asarray(data[start:start + frame_block], dtype=np.float32)
+        for axis, (taps, weights) in enumerate(spatial, start=1):
+            block = resample_axis(block, axis, taps, weights)
+        out[start:start + frame_block] = block
+    if shape[0] != data.shape[0]:
+        out = resample_axis(out, 0, *axis_weights(data.shape[0], shape[0], periodic_frames, nearest))
+    return out
+
+
+def resample_labels(labels: np.ndarray, shape, mode=label_mode) -> np.ndarray:
+    """Resample labels either by nearest neighbour or by majority: every label's indicator is resampled like an
+    intensity and each voxel takes the label with the largest share."""
+    if mode == "nearest":
+        return resample(labels, shape, nearest=True).astype(labels.dtype)
+    if mode != "majority":
+        raise ValueError(f"Unknown label mode: \"{mode}\"")
+    best_share = np.full(shape, -1, dtype=np.float32)
+    best_label = np.zeros(shape, dtype=labels.dtype)
+    for label in np.unique(labels):
+        share = resample(labels == label, shape)
+        better = share > best_share
+        best_share[better] = share[better]
+        best_label[better] = label
+    return best_label
+
+
+def resampled_header(header: dict, src_shape, dst_shape) -> dict:
+    """Copy of an nrrd header with its (x, y, slice) spacing and origin updated for a resampled (x, y, slice, frame) grid."""
+    out = {key: value for key, value in header.items()
+           if key not in ("type", "dimension", "sizes", "endian", "encoding", "data file", "datafile")}
+    out["encoding"] = generate_phantoms.encoding
+    scales = [n_src / n_dst for n_src, n_dst in zip(src_shape[:3], dst_shape[:3])]
+    if "space directions" in header:
+        directions = np.array(header["space directions"], dtype=float)
+        if "space origin" in header:
+            # Voxel centres move with the grid so that both cover the same extent
+            origin = np.asarray(header["space origin"], dtype=float)
+            out["space origin"] = origin + sum(directions[axis] * (scale - 1) / 2 for axis, scale in enumerate(scales))
+        directions[:3] *= np.asarray(scales)[:, None]
+        out["space directions"] = directions
+    elif "spacings" in header:
+        spacings = np.array(header["spacings"], dtype=float)
+        spacings[:3] *= scales
+        out["spacings"] = spacings
+    return out
+
+
+def write_like(path: str, data: np.ndarray, header: dict):
+    nrrd.write(f"{path}.tmp.nrrd", data.T, header, compression_level=generate_phantoms.compression_level)
+    os.replace(f"{path}.tmp.nrrd", path)
+
+
+def resample_case(vol_path: str, out_prefix: str) -> str:
+    """Resample one case's volume and segmentation into {out_prefix}_vol.nrrd / _seg.nrrd."""
+    outputs = []
+    for path in (vol_path, vol_path.replace("_vol", "_seg")):
+        header, data_offset = simulated_nrrd_loader.read_header(path)
+        # (x, y, slice, frame) on disk; the transpose is (frame, slice, y, x)
+        data = simulated_nrrd_loader.map_file_as_np(path, header, data_offset).T
+        if data.ndim != 4:
+            raise simulated_nrrd_loader.DatasetError(f"Expected a 4-D (x, y, slice, frame) nrrd: {path}")
+        shape = (n_frames or data.shape[0], n_slices, size, size)
+        if path == vol_path:
+            out = resample(data, shape)
+            if np.issubdtype(data.dtype, np.integer):
+                info = np.iinfo(data.dtype)
+                out = np.clip(np.rint(out), info.min, info.max)
+            out = out.astype(data.dtype)
+        else:
+            out = resample_labels(data, shape)
+        outputs.append((out, resampled_header(header, data.shape[::-1], shape[::-1])))
+
+    # Segmentation first: the volume marks the case as done
+    write_like(f"{out_prefix}_seg.nrrd", *outputs[1])
+    write_like(f"{out_prefix}_vol.nrrd", *outputs[0])
+    return out_prefix
+
+
+def main():
+    out_dir = os.path.join(in_dir, output_name())
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for vol_path in simulated_nrrd_loader.get_dataset_paths([dataset]):
+        out_prefix = os.path.join(out_dir, os.path.basename(vol_path)[:-len("_vol.nrrd")])
+        if not os.path.exists(f"{out_prefix}_vol.nrrd"):
+            jobs.append((vol_path, out_prefix))
+    print(f"Resampling {len(jobs)} case(s) from '{dataset}' into '{out_dir}'")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(resample_case, *job) for job in jobs]
+        for future in tqdm(futures, desc="Resampling"):
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# Volumes here are (frame, slice, a, b) tensors as returned by the loaders. Planes are described in physical
+# (slice, a, b) coordinates, i.e. voxel indices scaled by voxel_size, so anisotropic slice spacing is respected.
+
+
+class Plane:
+    """A rectangular sampling plane: size[0] rows along v and size[1] columns along u, step apart, around center."""
+
+    def __init__(self, center, u, v, size=(256, 256), step=1.0):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.u = np.asarray(u, dtype=np.float64) / np.linalg.norm(u)
+        self.v = np.asarray(v, dtype=np.float64) / np.linalg.norm(v)
+        self.size = tuple(size)
+        self.step = step
+
+    def points(self) -> np.ndarray:
+        """Physical coordinates of every sample, shaped (rows, cols, 3)."""
+        rows = (np.arange(self.size[0]) - (self.size[0] - 1) / 2) * self.step
+        cols = (np.arange(self.size[1]) - (self.size[1] - 1) / 2) * self.step
+        return self.center + rows[:, None, None] * self.v + cols[None, :, None] * self.u
+
+
+def plane_grid(plane: Plane, volume_shape, voxel_size=(1.0, 1.0, 1.0)) -> torch.Tensor:
+    """Normalized grid_sample coordinates of a plane within a (slice, a, b) volume, shaped (1, 1, rows, cols, 3)."""
+    voxels = plane.points() / np.asarray(voxel_size, dtype=np.float64)
+    extent = np.maximum(np.asarray(volume_shape[-3:], dtype=np.float64) - 1, 1)
+    normalized = 2 * voxels / extent - 1
+
+    # grid_sample wants (x, y, z) = (b, a, slice)
+    return torch.from_numpy(normalized[..., ::-1].copy()).float()[None, None]
+
+
+def reslice(volume: torch.Tensor, grid: torch.Tensor, mode="bilinear") -> torch.Tensor:
+    """Sample one plane from every frame of a (frame, slice, a, b) volume in a single batched call.
+
+    Use mode="bilinear" (trilinear in 3-D) for intensities and mode="nearest" for labels. Samples outside the
+    volume are zero (background)."""
+    n_frames = volume.shape[0]
+    source = volume[:, None].float()
+    out = F.grid_sample(source, grid.to(source.device).expand(n_frames, -1, -1, -1, -1),
+                        mode=mode, padding_mode="zeros", align_corners=True)
+    out = out[:, 0, 0]
+    return out if mode != "nearest" else out.to(volume.dtype)
+
+
+def fit_long_axis(label: torch.Tensor, labels, voxel_size=(1.0, 1.0, 1.0), frame=0) -> tuple[np.ndarray, np.ndarray]:
+    """Estimate the heart's long axis as the principal direction of the given labels in one frame.
+
+    Returns (center, unit axis) in physical coordinates; falls back to the stack axis through the volume centre
+    when none of the labels are present."""
+    shape = np.asarray(label.shape[-3:], dtype=np.float64)
+    mask = torch.isin(label[frame], torch.as_tensor(list(labels), dtype=label.dtype)).numpy()
+    coords = np.argwhere(mask) * np.asarray(voxel_size, dtype=np.float64)
+    if len(coords) < 3:
+        return (shape - 1) / 2 * np.asarray(voxel_size), np.array([1.0, 0.0, 0.0])
+
+    center = coords.mean(axis=0)
+    _, _, vt = np.linalg.svd(coords - center, full_matrices=False)
+    axis = vt[0]
+
+    # Point the axis along increasing slice index so views keep a stable orientation
+    if axis[0] < 0:
+        axis = -axis
+    return center, axis
+
+
+def _perpendicular(axis: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Seed with whichever volume axis is least aligned to the long axis
+    reference = np.eye(3)[np.argmin(np.abs(axis))]
+    u = np.cross(axis, reference)
+    u /= np.linalg.norm(u)
+    return u, np.cross(axis, u)
+
+
+def short_axis_plane(center, axis, offset=0.0, size=(256, 256), step=1.0) -> Plane:
+    """Plane perpendicular to the long axis, offset along it from the centre."""
+    u, v = _perpendicular(axis)
+    return Plane(np.asarray(center) + offset * np.asarray(axis), u, v, size, step)
+
+
+def long_axis_plane(center, axis, angle=0.0, size=(256, 256), step=1.0) -> Plane:
+    """Plane containing the long axis, rotated about it by angle (radians)."""
+    u, v = _perpendicular(axis)
+    return Plane(center, np.cos(angle) * u + np.sin(angle) * v, axis, size, step)
+
+
+class Reslicer:
+    """Per-case cache of fitted axes and sampling grids, so revisiting a view only costs the sampling itself."""
+
+    def __init__(self, labels=(1, 2), voxel_size=(1.0, 1.0, 1.0), size=(256, 256), step=1.0):
+        self.labels = labels            # label ids the long axis is fitted to
+        self.voxel_size = voxel_size    # (slice, a, b) spacing of cases without their own (see set_voxel_size)
+        self.size = size
+        self.step = step
+        self.voxel_sizes = {}
+        self.axes = {}
+        self.grids = {}
+
+    def set_voxel_size(self, case_key, voxel_size):
+        """Use a case's own (slice, a, b) spacing, e.g. from its header, dropping anything fitted at another."""
+        voxel_size = tuple(float(size) for size in voxel_size)
+        if self.voxel_sizes.get(case_key) != voxel_size:
+            self.voxel_sizes[case_key] = voxel_size
+            self.axes.pop(case_key, None)
+            self.grids = {key: grid for key, grid in self.grids.items() if key[0] != case_key}
+
+    def case_voxel_size(self, case_key) -> tuple:
+        return self.voxel_sizes.get(case_key, self.voxel_size)
+
+    def axis(self, case_key, label: torch.Tensor) -> tuple[np.ndarray, np.ndarray]:
+        if case_key not in self.axes:
+            self.axes[case_key] = fit_long_axis(label, self.labels, self.case_voxel_size(case_key))
+        return self.axes[case_key]
+
+    def grid(self, case_key, label: torch.Tensor, view: str, position: float) -> torch.Tensor:
+        """Sampling grid for a "short" (position = offset along the axis) or "long" (position = angle) view."""
+        key = (case_key, view, float(position), tuple(label.shape[-3:]))
+        if key not in self.grids:
+            center, axis = self.axis(case_key, label)
+            if view == "short":
+                plane = short_axis_plane(center, axis, position, self.size, self.step)
+            elif view == "long":
+                plane = long_axis_plane(center, axis, position, self.size, self.step)
+            else:
+                raise ValueError(f"Unknown view: \"{view}\"")
+            self.grids[key] = plane_grid(plane, label.shape, self.case_voxel_size(case_key))
+        return self.grids[key]
+
+    def __call__(self, case_key, volume: torch.Tensor, label: torch.Tensor, view: str, position=0.0):
+        """Reslice every frame of a case, returning (frame, rows, cols) intensity and label planes."""
+        grid = self.grid(case_key, label, view, position)
+        return reslice(volume, grid, "bilinear"), reslice(label, grid, "nearest")
@@ -0,0 +1,166 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import nrrd_convert
+import simulated_nrrd_loader
+
+
+index_path = f"{Path('./').parent.absolute()}/data/roi_index.json"
+num_workers = os.cpu_count()
+margin = 8                      # voxels of context kept around the labels on every cropped axis
+crop_size = (128, 128)          # fixed (x, y[, slice]) crop for batching, or None for tight per-case boxes
+
+# Boxes are half-open [lo, hi) voxel ranges over the nrrd's own (x, y, slice) axes, so they apply to any of the
+# orientations the loaders and converters put on top
+
+
+def frame_boxes(mask_path: str) -> list:
+    """[x0, x1, y0, y1, z0, z1] of the non-background labels in each frame (None for empty frames)."""
+    boxes = []
+    for frame in simulated_nrrd_loader.iter_file_frames(mask_path):
+        mask = np.asarray(frame) != 0
+        box = []
+        for axis in range(3):
+            present = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+            box.extend([int(present[0]), int(present[-1]) + 1] if len(present) else [])
+        boxes.append(box if len(box) == 6 else None)
+    return boxes
+
+
+def _stamp(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_index(path=index_path) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def build(mask_paths, path=index_path) -> dict:
+    """Add or refresh the boxes of every mask, skipping those whose files are unchanged."""
+    index = load_index(path)
+    jobs = [os.path.abspath(mask_path) for mask_path in mask_paths]
+    jobs = [mask_path for mask_path in jobs if index.get(mask_path, {}).get("stamp") != _stamp(mask_path)]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(frame_boxes, jobs) if jobs else []
+        for mask_path, boxes in tqdm(zip(jobs, results), total=len(jobs), desc="Indexing ROIs"):
+            sizes = [int(size) for size in simulated_nrrd_loader.read_header(mask_path)[0]["sizes"]]
+            index[mask_path] = {"stamp": _stamp(mask_path), "sizes": sizes, "boxes": boxes}
+
+    if not jobs:
+        return index
+
+    # Write atomically so an interrupted build never leaves a truncated index, under a per-process temporary name
+    # as every rank of a distributed run builds the same index
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+    return index
+
+
+def case_box(entry: dict, margin=margin, crop_size=crop_size) -> list:
+    """One [lo, hi) range per (x, y, slice) axis covering the labels in every frame of a case, plus margin.
+
+    With crop_size the box is instead centred on the labels with exactly that size, shifted to stay inside the
+    volume where it fits; axes crop_size leaves out are kept whole. Empty cases fall back to the volume centre."""
+    sizes = entry["sizes"][:3]
+    boxes = np.array([box for box in entry["boxes"] if box is not None]).reshape(-1, 6)
+    if len(boxes) > 0:
+        lo, hi = boxes[:, 0::2].min(axis=0), boxes[:, 1::2].max(axis=0)
+    else:
+        lo, hi = np.array(sizes) // 2, np.array(sizes) // 2 + 1
+
+    ranges = []
+    for axis, size in enumerate(sizes):
+        if crop_size is None:
+            ranges.append([max(int(lo[axis]) - margin, 0), min(int(hi[axis]) + margin, size)])
+        elif axis < len(crop_size):
+            start = (int(lo[axis]) + int(hi[axis]) - crop_size[axis]) // 2
+            if crop_size[axis] <= size:
+                start = min(max(start, 0), size - crop_size[axis])
+            else:
+                # Centre the whole axis in a zero-padded crop
+                start = (size - crop_size[axis]) // 2
+            ranges.append([start, start + crop_size[axis]])
+        else:
+            ranges.append([0, size])
+    return ranges
+
+
+def load_cropped_file(path: str, box) -> np.ndarray:
+    """Read one nrrd cropped to box, frame by frame, as a Fortran-ordered (x, y, slice[, frame]) array.
+
+    Only the cropped voxels of each frame are copied out (raw files are only paged in where the crop falls);
+    parts of the box outside the volume are zero-padded."""
+    header, data_offset = simulated_nrrd_loader.read_header(path)
+    sizes = [int(size) for size in header["sizes"]]
+    shape = tuple(hi - lo for lo, hi in box) + tuple(sizes[3:])
+    out = np.zeros(shape, dtype=simulated_nrrd_loader.header_dtype(header).newbyteorder("="), order="F")
+
+    # Intersect the box with the volume
+    src = tuple(slice(max(lo, 0), min(hi, size)) for (lo, hi), size in zip(box, sizes))
+    dst = tuple(slice(s.start - lo, s.stop - lo) for s, (lo, _) in zip(src, box))
+    for frame_i, frame in enumerate(simulated_nrrd_loader.iter_file_frames(path, header, data_offset)):
+        out[dst + ((frame_i,) if len(sizes) == 4 else ())] = frame[src]
+    return out
+
+
+def load_cropped_pairs(pairs, reorder=(3, 2, 1, 0), index=None, margin=margin, crop_size=crop_size) -> tuple[list, list]:
+    """Cropped (image, label) tensors for (image path, mask path) pairs, permuted by reorder like the loaders' tensors."""
+    index = build([mask_path for _, mask_path in pairs]) if index is None else index
+    images, labels = [], []
+    for image_path, mask_path in pairs:
+        box = case_box(index[os.path.abspath(mask_path)], margin, crop_size)
+        image, label = load_cropped_file(image_path, box), load_cropped_file(mask_path, box)
+        images.append(torch.from_numpy(image).permute(reorder))
+        labels.append(torch.from_numpy(label).permute(reorder))
+    return images, labels
+
+
+def load_cropped_tensors(active_datasets,
+                         split=[1.0, 0.0, 0.0],
+                         reorder=(3, 2, 1, 0),
+                         margin=margin,
+                         crop_size=crop_size,
+                         seed=None,
+                         strata=None,
+                         rank=0,
+                         world_size=1,
+                         epoch=0) -> list[tuple[list, list]]:
+    """Same splits and sharding as simulated_nrrd_loader.load_data_as_tensors, but each case is cropped to its ROI."""
+    vol_paths = simulated_nrrd_loader.get_dataset_paths(active_datasets)
+    pairs = [(path, path.replace("_vol", "_seg")) for path in vol_paths]
+    index = build([mask_path for _, mask_path in pairs])
+
+    out = []
+    for paths in simulated_nrrd_loader.split_and_shard_paths(vol_paths, split, seed, strata, rank, world_size, epoch):
+        out.append(load_cropped_pairs([(path, path.replace("_vol", "_seg")) for path in paths], reorder, index,
+                                      margin, crop_size))
+    return out
+
+
+def load_cropped_utah(dataset_dir: str, margin=margin, crop_size=crop_size) -> tuple[list, list]:
+    """Cropped (slice, a, b) image and atrium mask tensors for every Utah case that has a mask."""
+    pairs = [(image_path, mask_path) for _, image_path, mask_path in nrrd_convert.UtahMiccaiAdapter(dataset_dir).cases()
+             if mask_path is not None]
+    return load_cropped_pairs(pairs, (2, 1, 0), margin=margin, crop_size=crop_size)
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    volumes, labels = load_cropped_tensors(active_datasets)[0]
+    full = sum(np.prod(simulated_nrrd_loader.read_header(path)[0]["sizes"]) for path in
+               simulated_nrrd_loader.get_dataset_paths(active_datasets))
+    cropped = sum(volume.numel() for volume in volumes)
+    print(f"{len(volumes)} case(s): {cropped} of {full} voxels kept ({full / max(cropped, 1):.1f}x smaller)")
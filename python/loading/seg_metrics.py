@@ -0,0 +1,145 @@
+import csv
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from scipy import ndimage
+from tqdm import tqdm
+
+import distance_maps
+import generate_phantoms
+import simulated_nrrd_loader
+
+
+out_dir = f"{Path('./').parent.absolute()}/data/qa"
+reference_dataset = "19x256"
+test_dataset = "19x256_regenerated"     # e.g. the same cases exported from a newer heart model
+num_workers = os.cpu_count()
+labels = distance_maps.labels
+
+# Per (frame, label): Dice, Hausdorff distance, its 95th percentile and the average symmetric surface distance (mm),
+# plus the label's volume (mL) in each dataset. Undefined entries (a label missing on one or both sides) are nan.
+METRICS = ("dice", "hd", "hd95", "assd", "ref_ml", "test_ml")
+
+
+def surface(mask: np.ndarray) -> np.ndarray:
+    """Voxels of the mask with a face-neighbour outside it."""
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def surface_distances(ref: np.ndarray, test: np.ndarray, spacing) -> tuple[np.ndarray, np.ndarray]:
+    """Distances (mm) from every surface voxel of ref to the surface of test, and the other way around.
+
+    Both masks must be non-empty. Distance transforms are taken over the masks' joint bounding box only (plus a
+    voxel), which is exact since every surface voxel, and so every nearest one, lies inside it."""
+    present = np.argwhere(ref | test)
+    lo, hi = np.maximum(present.min(axis=0) - 1, 0), present.max(axis=0) + 2
+    box = tuple(slice(start, stop) for start, stop in zip(lo, hi))
+    ref_surface, test_surface = surface(ref[box]), surface(test[box])
+    to_test = ndimage.distance_transform_edt(~test_surface, sampling=spacing)
+    to_ref = ndimage.distance_transform_edt(~ref_surface, sampling=spacing)
+    return to_test[ref_surface], to_ref[test_surface]
+
+
+def frame_metrics(ref: np.ndarray, test: np.ndarray, spacing, labels=labels) -> np.ndarray:
+    """(label, metric) array comparing two label volumes of the same grid."""
+    out = np.full((len(labels), len(METRICS)), np.nan)
+    n_labels = max(int(ref.max()), int(test.max()), max(labels)) + 1
+
+    # One confusion matrix gives every label's overlap and voxel counts
+    confusion = np.bincount(ref.ravel().astype(np.int64) * n_labels + test.ravel(),
+                            minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+    ref_counts, test_counts, overlap = confusion.sum(axis=1), confusion.sum(axis=0), np.diag(confusion)
+    voxel_ml = np.prod(spacing) / 1000
+    for label_i, label in enumerate(labels):
+        out[label_i, METRICS.index("ref_ml")] = ref_counts[label] * voxel_ml
+        out[label_i, METRICS.index("test_ml")] = test_counts[label] * voxel_ml
+        if ref_counts[label] + test_counts[label] > 0:
+            out[label_i, METRICS.index("dice")] = 2 * overlap[label] / (ref_counts[label] + test_counts[label])
+        if ref_counts[label] > 0 and test_counts[label] > 0:
+            to_test, to_ref = surface_distances(ref == label, test == label, spacing)
+            out[label_i, METRICS.index("hd")] = max(to_test.max(), to_ref.max())
+            out[label_i, METRICS.index("hd95")] = max(np.percentile(to_test, 95), np.percentile(to_ref, 95))
+            out[label_i, METRICS.index("assd")] = (to_test.sum() + to_ref.sum()) / (len(to_test) + len(to_ref))
+    return out
+
+
+def compare_case(ref_path: str, test_path: str, labels=labels) -> np.ndarray:
+    """(frame, label, metric) array comparing two segmentation nrrds of one case, a frame at a time."""
+    ref_header, ref_offset = simulated_nrrd_loader.read_header(ref_path)
+    test_header, test_offset = simulated_nrrd_loader.read_header(test_path)
+    if list(ref_header["sizes"]) != list(test_header["sizes"]):
+        raise simulated_nrrd_loader.DatasetError(f"Grids differ: {ref_path} {list(ref_header['sizes'])} vs "
+                                                 f"{test_path} {list(test_header['sizes'])}")
+    spacing = distance_maps.voxel_spacing(ref_header)
+    frames = zip(simulated_nrrd_loader.iter_file_frames(ref_path, ref_header, ref_offset),
+                 simulated_nrrd_loader.iter_file_frames(test_path, test_header, test_offset))
+    return np.stack([frame_metrics(np.asarray(ref), np.asarray(test), spacing, labels) for ref, test in frames])
+
+
+def case_segmentations(dataset: str) -> dict[str, str]:
+    return {os.path.basename(path)[:-len("_vol.nrrd")]: path.replace("_vol", "_seg")
+            for path in simulated_nrrd_loader.get_dataset_paths([dataset])}
+
+
+def compare_datasets(reference: str, test: str, labels=labels) -> dict[str, np.ndarray]:
+    """Metrics of every case the two datasets share, by case name."""
+    ref_cases, test_cases = case_segmentations(reference), case_segmentations(test)
+    names = sorted(set(ref_cases) & set(test_cases))
+    unmatched = len(set(ref_cases) ^ set(test_cases))
+    print(f"Comparing {len(names)} case(s) of '{test}' against '{reference}'"
+          + (f" ({unmatched} without a counterpart skipped)" if unmatched else ""))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {name: executor.submit(compare_case, ref_cases[name], test_cases[name], labels) for name in names}
+        return {name: future.result() for name, future in tqdm(futures.items(), desc="Comparing")}
+
+
+def summary(results: dict[str, np.ndarray], labels=labels) -> dict[int, dict]:
+    """Per label: every metric's mean over defined (case, frame) entries, plus the worst Dice and the mean
+    relative volume difference."""
+    out = {}
+    all_frames = np.concatenate(list(results.values())) if results else np.full((0, len(labels), len(METRICS)), np.nan)
+    for label_i, label in enumerate(labels):
+        values = all_frames[:, label_i]
+        # Labels absent from every case leave all-nan columns
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            stats = {metric: float(np.nanmean(values[:, i])) for i, metric in enumerate(METRICS)}
+            stats["min_dice"] = float(np.nanmin(values[:, METRICS.index("dice")])) if len(values) else float("nan")
+            ref_ml, test_ml = values[:, METRICS.index("ref_ml")], values[:, METRICS.index("test_ml")]
+            stats["volume_diff"] = float(np.nanmean(np.where(ref_ml > 0, (test_ml - ref_ml) / ref_ml, np.nan)))
+        out[label] = stats
+    return out
+
+
+def write_csv(path: str, results: dict[str, np.ndarray], labels=labels):
+    """One row per (case, frame, label)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["case", "frame", "label", *METRICS])
+        for name, metrics in results.items():
+            for frame_i, frame in enumerate(metrics):
+                for label, values in zip(labels, frame):
+                    writer.writerow([name, frame_i, label, *(f"{value:.6g}" for value in values)])
+    os.replace(f"{path}.tmp", path)
+
+
+def print_summary(stats: dict[int, dict]):
+    names = {value: key for key, value in generate_phantoms.LABELS.items()}
+    print(f"{'label':>8s} {'dice':>7s} {'min':>7s} {'hd':>7s} {'hd95':>7s} {'assd':>7s} {'ref mL':>8s} {'test mL':>8s} {'diff':>7s}")
+    for label, row in stats.items():
+        print(f"{names.get(label, label):>8} {row['dice']:7.3f} {row['min_dice']:7.3f} {row['hd']:7.2f} {row['hd95']:7.2f} "
+              f"{row['assd']:7.2f} {row['ref_ml']:8.1f} {row['test_ml']:8.1f} {row['volume_diff']:7.1%}")
+
+
+def main():
+    results = compare_datasets(reference_dataset, test_dataset)
+    write_csv(os.path.join(out_dir, f"{test_dataset}_vs_{reference_dataset}.csv"), results)
+    print_summary(summary(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,393 @@
+import bz2
+import collections
 import nrrd
 import glob
 from pathlib import Path
 import os
+import json
 import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 
 
+# Map NRRD type names onto numpy dtype strings (endianness is added from the header)
+NRRD_TYPES = {
+    "signed char": "i1", "int8": "i1", "int8_t": "i1",
+    "uchar": "u1", "unsigned char": "u1", "uint8": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "longlong": "i8", "long long": "i8", "long long int": "i8", "signed long long": "i8",
+    "signed long long int": "i8", "int64": "i8", "int64_t": "i8",
+    "ulonglong": "u8", "unsigned long long": "u8", "unsigned long long int": "u8", "uint64": "u8", "uint64_t": "u8",
+    "float": "f4",
+    "double": "f8",
+}
+
+
 class DatasetError(Exception):
     pass
 
 
+class _NullSpan:
+    """Stand-in span handed out while telemetry is disabled, so instrumented code costs one attribute check."""
+    n_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+    def __init__(self, telemetry, name, path, n_bytes):
+        self.telemetry = telemetry
+        self.name = name
+        self.path = path
+        self.n_bytes = n_bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.telemetry.record({
+            "name": self.name,
+            "path": self.path,
+            "bytes": self.n_bytes,
+            "start": self.start - self.telemetry.origin,
+            "seconds": end - self.start,
+            "thread": threading.get_ident(),
+        })
+        return False
+
+
+class Telemetry:
+    """Opt-in per-file and aggregate I/O timings and counters for this module.
+
+    Disabled by default. Enable with telemetry.enable() (or SIMULATED_NRRD_TELEMETRY=1), then export with
+    to_json or to_chrome_trace (viewable in chrome://tracing or Perfetto)."""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_allocations = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.counters = {}
+        self.origin = time.perf_counter()
+
+    def enable(self, trace_allocations=False):
+        """Start recording; trace_allocations also tracks peak numpy/Python allocation with tracemalloc."""
+        self.enabled = True
+        self.trace_allocations = trace_allocations
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def span(self, name, path=None, n_bytes=0):
+        if not self.enabled:
+            return _null_span
+        return _Span(self, name, path, n_bytes)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self) -> dict:
+        """Aggregate and per-file totals of every recorded span, plus counters and peak memory."""
+        aggregate, per_file = {}, {}
+        for event in self.events:
+            targets = [aggregate]
+            if event["path"] is not None:
+                targets.append(per_file.setdefault(event["path"], {}))
+            for target in targets:
+                totals = target.setdefault(event["name"], {"count": 0, "seconds": 0.0, "bytes": 0})
+                totals["count"] += 1
+                totals["seconds"] += event["seconds"]
+                totals["bytes"] += event["bytes"]
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        summary = {
+            "aggregate": aggregate,
+            "per_file": per_file,
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss / 1024 if sys.platform != "darwin" else peak_rss / 1024**2,
+        }
+        if tracemalloc.is_tracing():
+            summary["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        return summary
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def to_chrome_trace(self, path):
+        trace = [{
+            "name": event["name"],
+            "ph": "X",
+            "ts": event["start"] * 1e6,
+            "dur": event["seconds"] * 1e6,
+            "pid": os.getpid(),
+            "tid": event["thread"],
+            "args": {"path": event["path"], "bytes": event["bytes"]},
+        } for event in self.events]
+        trace.extend({"name": name, "ph": "C", "ts": 0, "pid": os.getpid(), "args": {name: value}}
+                     for name, value in self.counters.items())
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace}, f)
+
+
+telemetry = Telemetry()
+if os.environ.get("SIMULATED_NRRD_TELEMETRY") == "1":
+    telemetry.enable()
+
+
 def load_file_as_np(filepath) -> np.ndarray:
     if not os.path.exists(filepath):
         print(f"Could not find file at address {filepath}")
         return np.array()
     
-    data, _ = nrrd.read(filepath)
+    with telemetry.span("decode", filepath, os.path.getsize(filepath) if telemetry.enabled else 0):
+        data, _ = nrrd.read(filepath)
     return data
 
 
-def load_data_as_np(active_datasets) -> list[tuple]:
+def read_header(filepath) -> tuple[dict, int]:
+    """Read only the header of an nrrd file, returning it along with the byte offset of its voxel data."""
+    with telemetry.span("header", filepath) as span, open(filepath, "rb") as fh:
+        header = nrrd.read_header(fh)
+        data_offset = fh.tell()
+        span.n_bytes = data_offset
+
+    # Detached data starts at the top of its own file
+    if "data file" in header or "datafile" in header:
+        data_offset = 0
+
+    return header, data_offset
+
+
+def header_dtype(header) -> np.dtype:
+    dtype = np.dtype(NRRD_TYPES[header["type"]])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder("<" if header.get("endian", "little") == "little" else ">")
+    return dtype
+
+
+def header_data_path(filepath, header) -> str:
+    data_path = header.get("data file", header.get("datafile"))
+    if data_path is None:
+        return filepath
+    if not os.path.isabs(data_path):
+        data_path = os.path.join(os.path.dirname(filepath), data_path)
+    return data_path
+
+
+def header_spacing(header) -> list:
+    """Per-axis voxel spacing from either 'spacings' or the norms of 'space directions'."""
+    if "spacings" in header:
+        return [float(s) for s in header["spacings"]]
+    if "space directions" in header:
+        spacing = []
+        for direction in header["space directions"]:
+            direction = np.asarray(direction, dtype=float)
+            spacing.append(None if np.isnan(direction).any() else float(np.linalg.norm(direction)))
+        return spacing
+    return None
+
+
+def map_file_as_np(filepath, header=None, data_offset=None) -> np.ndarray:
+    """Memory-map the voxels of a raw-encoded nrrd, falling back to a full read for compressed encodings."""
+    if header is None:
+        header, data_offset = read_header(filepath)
+
+    # Only raw data can be mapped straight off the disk
+    if header["encoding"] != "raw" or header.get("line skip", header.get("lineskip", 0)) != 0:
+        return load_file_as_np(filepath)
+
+    # Resolve where the voxels live
+    data_path = header_data_path(filepath, header)
+    shape = tuple(header["sizes"])
+    dtype = header_dtype(header)
+
+    # Apply byte skip (-1 means the data sits at the end of the file)
+    byte_skip = header.get("byte skip", header.get("byteskip", 0))
+    if byte_skip == -1:
+        data_offset = os.path.getsize(data_path) - dtype.itemsize * int(np.prod(shape))
+    else:
+        data_offset += byte_skip
+
+    # Copy-on-write so that torch can wrap the map without complaining about read-only memory
+    with telemetry.span("map", filepath) as span:
+        arr = np.memmap(data_path, dtype=dtype, mode="c", offset=data_offset, shape=shape, order="F")
+        span.n_bytes = arr.nbytes
+    return arr
+
+
+def is_streamable(header) -> bool:
+    """Whether the data is compressed in a way that can be decoded chunk by chunk."""
+    return header["encoding"] in ("gzip", "gz", "bzip2", "bz2") \
+        and header.get("byte skip", header.get("byteskip", 0)) >= 0 \
+        and header.get("line skip", header.get("lineskip", 0)) == 0
+
+
+def header_decompressor(header):
+    if header["encoding"] in ("gzip", "gz"):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    return bz2.BZ2Decompressor()
+
+
+def _fill_decompressed(fh, decompressor, view, filepath, span):
+    """Fill a writable byte view with the decompressed stream of fh, read a chunk at a time.
+
+    The decompressor is never asked for more than the view (or one chunk) has room for: zlib hands back the input it
+    did not get to as unconsumed_tail, and bz2 keeps it until needs_input says to read on."""
+    pos = 0
+    while pos < len(view):
+        if decompressor.eof:
+            raise DatasetError(f"Ran out of data while decoding {filepath}")
+        if isinstance(decompressor, bz2.BZ2Decompressor):
+            chunk = fh.read(1 << 22) if decompressor.needs_input else b""
+            span.n_bytes += len(chunk)
+        else:
+            chunk = decompressor.unconsumed_tail
+            if not chunk:
+                chunk = fh.read(1 << 22)
+                span.n_bytes += len(chunk)
+        data = decompressor.decompress(chunk, min(len(view) - pos, 1 << 20))
+        if not data and not chunk:
+            raise DatasetError(f"Ran out of data while decoding {filepath}")
+        view[pos:pos + len(data)] = data
+        pos += len(data)
+
+
+def _skip_decompressed(fh, decompressor, n_bytes, filepath, span):
+    """Decompress and drop the next n_bytes of the stream, e.g. a byte skip."""
+    scratch = bytearray(min(n_bytes, 1 << 22))
+    while n_bytes > 0:
+        n = min(n_bytes, len(scratch))
+        _fill_decompressed(fh, decompressor, memoryview(scratch)[:n], filepath, span)
+        n_bytes -= n
+
+
+def decode_file_as_np(filepath, out=None) -> np.ndarray:
+    """Read an nrrd in the same layout as nrrd.read, decompressing chunk by chunk straight into out.
+
+    out may be a preallocated Fortran-ordered array of the file's shape and dtype. zlib releases the GIL while
+    inflating, so several files can be decoded at once from threads (see load_files_as_np)."""
+    header, data_offset = read_header(filepath)
+    shape = tuple(int(size) for size in header["sizes"])
+    dtype = header_dtype(header)
+    if out is None:
+        out = np.empty(shape, dtype=dtype, order="F")
+    elif out.shape != shape or not out.flags.f_contiguous:
+        raise DatasetError(f"Buffer of shape {out.shape} cannot hold {filepath} of shape {shape}")
+
+    # Raw data is copied straight off the map
+    if not is_streamable(header):
+        out[...] = map_file_as_np(filepath, header, data_offset)
+        return out
+
+    # View the buffer as bytes in memory order and inflate into it, never asking for more than it has room for
+    raw = out.ravel(order="K").view(np.uint8)
+    decompressor = header_decompressor(header)
+    skip = header.get("byte skip", header.get("byteskip", 0))
+    with telemetry.span("decode", filepath) as span, open(header_data_path(filepath, header), "rb") as fh:
+        fh.seek(data_offset)
+        if skip > 0:
+            _skip_decompressed(fh, decompressor, skip, filepath, span)
+        _fill_decompressed(fh, decompressor, memoryview(raw), filepath, span)
+    return out
+
+
+def load_files_as_np(paths, num_threads=os.cpu_count()) -> list[np.ndarray]:
+    """Decode several nrrd files concurrently, returning arrays in the same order as paths."""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(decode_file_as_np, paths))
+
+
+def reencode_file(filepath, out_path=None, encoding="raw", compression_level=1, in_place=False):
+    """Rewrite an nrrd with a cheaper encoding (raw, or gzip at a fast level) to out_path, or over itself if in_place."""
+    if in_place and out_path not in (None, filepath):
+        raise ValueError(f"in_place rewrites {filepath} itself, but out_path {out_path} was also given")
+    if not in_place and out_path in (None, filepath):
+        raise ValueError(f"Pass an out_path for {filepath}, or in_place=True to overwrite it")
+    out_path = filepath if in_place else out_path
+
+    header, _ = read_header(filepath)
+    data = decode_file_as_np(filepath)
+    header["encoding"] = encoding
+    for field in ("data file", "datafile", "byte skip", "byteskip", "line skip", "lineskip"):
+        header.pop(field, None)
+
+    # Write beside the target first so the original survives a failed write
+    nrrd.write(f"{out_path}.tmp", data, header, compression_level=compression_level)
+    os.replace(f"{out_path}.tmp", out_path)
+
+
+def iter_file_frames(filepath, header=None, data_offset=None):
+    """Yield an nrrd one frame (its last, slowest axis) at a time; 3-D files are a single frame.
+
+    Raw data is served as views of the memory map, and gzip/bzip2 data is decompressed incrementally so
+    that only about one frame of voxels is held at once."""
+    if header is None:
+        header, data_offset = read_header(filepath)
+    sizes = tuple(int(size) for size in header["sizes"])
+    frame_shape, n_frames = (sizes[:-1], sizes[-1]) if len(sizes) == 4 else (sizes, 1)
+    byte_skip = header.get("byte skip", header.get("byteskip", 0))
+
+    # Uncompressed (and unusual) layouts go through the map or a full read
+    if not is_streamable(header):
+        arr = map_file_as_np(filepath, header, data_offset)
+        for frame_i in range(n_frames):
+            yield arr[..., frame_i] if len(sizes) == 4 else arr
+        return
+
+    dtype = header_dtype(header)
+    frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+    decompressor = header_decompressor(header)
+
+    # Byte skip applies to the decompressed stream
+    with open(header_data_path(filepath, header), "rb") as fh:
+        fh.seek(data_offset)
+        for frame_i in range(n_frames):
+            with telemetry.span("decode_frame", filepath) as span:
+                if frame_i == 0 and byte_skip > 0:
+                    _skip_decompressed(fh, decompressor, byte_skip, filepath, span)
+                frame = bytearray(frame_bytes)
+                _fill_decompressed(fh, decompressor, memoryview(frame), filepath, span)
+            yield np.frombuffer(frame, dtype=dtype).reshape(frame_shape, order="F")
+
+
+def get_dataset_paths(active_datasets) -> list[str]:
     # Raise exception if no datasets are provided.
     if len(active_datasets) == 0:
         raise DatasetError("No datasets provided")
@@ -28,45 +395,204 @@ def load_data_as_np(active_datasets) -> list[tuple]:
     # Get directory that contains datasets by default
     unprocessed_data_dir = f"{Path('./main.py').parent.absolute()}/data/unprocessed"
     
-    # Load all nrrd files in the given datasets
+    # Collect all volume nrrd files in the given datasets
     paths = []
     for dataset in active_datasets:
         if not os.path.isdir(f"{unprocessed_data_dir}/{dataset}"):
             raise DatasetError(f"Could not find dataset: \"{dataset}\"")
-        paths.extend(glob.glob(f"{unprocessed_data_dir}/{dataset}/*_vol.nrrd"))
+        paths.extend(sorted(glob.glob(f"{unprocessed_data_dir}/{dataset}/*_vol.nrrd")))
 
-    data = [(nrrd.read(path)[0], nrrd.read(path.replace("_vol", "_seg"))[0]) for path in paths]
-    
-    # Shuffle tuples
-    random.shuffle(data)
+    return paths
+
+
+def split_paths(paths, split=[1.0, 0.0, 0.0], seed=None, strata=None) -> tuple[list, list, list]:
+    """Shuffle and split volume paths into (train, validation, test) before any voxels are read.
+
+    strata optionally maps each path (dict or callable) to a group key, e.g. from catalog metadata; every group is
+    then split by the same proportions so each split sees the same mix."""
+    rng = random.Random(seed)
+
+    # Group paths by stratum, keeping a stable order so the seed alone decides the split
+    groups = {}
+    for path in sorted(paths):
+        key = None if strata is None else (strata(path) if callable(strata) else strata[path])
+        groups.setdefault(key, []).append(path)
+
+    # Each stratum's counts are allocated by largest remainder against the running totals of all strata, so the
+    # remainders of small strata add up to the requested proportions instead of always landing in the same split
+    train, validation, test = [], [], []
+    seen, assigned = 0, [0, 0, 0]
+    for key in sorted(groups, key=str):
+        group = groups[key]
+        rng.shuffle(group)
+        seen += len(group)
+        wanted = [fraction * seen - n for fraction, n in zip(split, assigned)]
+        counts = [max(int(np.floor(want)), 0) for want in wanted]
+        while sum(counts) > len(group):
+            counts[max(range(3), key=lambda k: counts[k] - wanted[k] if counts[k] > 0 else -np.inf)] -= 1
+        while sum(counts) < len(group):
+            counts[max(range(3), key=lambda k: wanted[k] - counts[k])] += 1
+        assigned = [n + count for n, count in zip(assigned, counts)]
+        train.extend(group[:counts[0]])
+        validation.extend(group[counts[0]:counts[0] + counts[1]])
+        test.extend(group[counts[0] + counts[1]:])
+
+    # Mix the strata back together
+    for part in (train, validation, test):
+        rng.shuffle(part)
+    return train, validation, test
+
+
+def shard_paths(paths, rank=0, world_size=1, seed=None, epoch=0, balance=None) -> list:
+    """Reshuffle paths for an epoch and return this rank's disjoint share.
+
+    Every rank must pass the same seed and epoch. Share sizes differ by at most one; balance="drop" truncates
+    them to equal length and balance="pad" wraps around instead (so a few cases are seen twice)."""
+    # Without a shared seed each rank may hold its own split and order, so the shares could overlap
+    if world_size > 1 and seed is None:
+        raise ValueError("shard_paths needs a seed shared by every rank when world_size > 1")
+    paths = list(paths)
+    if seed is not None:
+        random.Random(f"{seed}:{epoch}").shuffle(paths)
+    if world_size == 1 or len(paths) == 0:
+        return paths
+
+    if balance == "drop":
+        paths = paths[:len(paths) - len(paths) % world_size]
+    elif balance == "pad":
+        padding = -len(paths) % world_size
+        paths += (paths * (padding // len(paths) + 1))[:padding]
+    return paths[rank::world_size]
+
+
+def split_and_shard_paths(paths, split, seed=None, strata=None, rank=0, world_size=1, epoch=0) -> list[list]:
+    """Train, validation and test paths of this rank: split_paths followed by shard_paths on each split."""
+    return [shard_paths(subset, rank, world_size, seed, epoch) for subset in split_paths(paths, split, seed, strata)]
+
+
+def load_paths_as_np(paths, num_threads=os.cpu_count()) -> list[tuple]:
+    # Decode volumes and segmentations concurrently
+    arrays = load_files_as_np([p for path in paths for p in (path, path.replace("_vol", "_seg"))], num_threads)
 
     # Return the data as tuples (volumes, segmentations)
-    return data
+    return list(zip(arrays[0::2], arrays[1::2]))
 
 
-def load_data_as_tensors(active_datasets, 
-                         split=[1.0, 0.0, 0.0],    # train, validation, test
-                         reorder=(3, 2, 1, 0)):
-    # Load nrrd files
-    data = load_data_as_np(active_datasets)
-    volumes, labels = [data_i[0] for data_i in data], [data_i[1] for data_i in data]
+def load_data_as_np(active_datasets) -> list[tuple]:
+    # Shuffle paths before reading so nothing is loaded just to be reordered
+    paths = get_dataset_paths(active_datasets)
+    random.shuffle(paths)
+    return load_paths_as_np(paths)
 
-    # Permute data and convert to tensor
-    volumes = [torch.tensor(volume).permute(reorder) for volume in volumes]
-    labels = [torch.tensor(label).permute(reorder) for label in labels]
 
-    # Split into train, validation, test
-    train_start = 0
-    val_start = int(len(volumes) * split[0])
-    test_start = int(len(volumes) * (1 - split[2]))
+class SimulatedNrrdDataset(torch.utils.data.Dataset):
+    """Lazy (volume, label) dataset that only reads headers up front and maps voxels on first access."""
 
-    train_data = (volumes[train_start : val_start], labels[train_start : val_start])
-    validation_data = (volumes[val_start : test_start], labels[val_start : test_start])
-    test_data = (volumes[test_start : -1], labels[test_start : -1])
+    def __init__(self, active_datasets=None, reorder=(3, 2, 1, 0), paths=None, max_decoded_bytes=2 * 1024**3):
+        self.reorder = reorder
 
-    # Return data
-    return train_data, validation_data, test_data
+        # Resolve volume paths and their segmentation pairs
+        self.vol_paths = list(paths) if paths is not None else get_dataset_paths(active_datasets)
+        self.seg_paths = [path.replace("_vol", "_seg") for path in self.vol_paths]
+
+        # Read headers only
+        self.vol_headers = [read_header(path) for path in self.vol_paths]
+        self.seg_headers = [read_header(path) for path in self.seg_paths]
+
+        # Voxel maps are opened on first access and kept (per file), as they cost no memory until paged in. Compressed
+        # files have to be decoded instead; those arrays are kept in a least recently used cache of max_decoded_bytes
+        self._mapped = {}
+        self._decoded = collections.OrderedDict()
+        self._decoded_bytes = 0
+        self.max_decoded_bytes = max_decoded_bytes
+        self._cache_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.vol_paths)
+
+    def shape(self, idx) -> tuple:
+        """Shape of a case in the reordered layout, taken from its header."""
+        sizes = self.vol_headers[idx][0]["sizes"]
+        return tuple(int(sizes[axis]) for axis in self.reorder)
 
+    def voxel_size(self, idx) -> tuple:
+        """(slice, a, b) voxel spacing of a case in the reordered layout, 1.0 where the header does not say."""
+        spacing = header_spacing(self.vol_headers[idx][0]) or []
+        spacing = [spacing[axis] if axis < len(spacing) and spacing[axis] is not None else 1.0
+                   for axis in self.reorder]
+        return tuple(spacing[1:])
+
+    def _array(self, path, header, data_offset) -> np.ndarray:
+        with self._cache_lock:
+            if path in self._decoded:
+                self._decoded.move_to_end(path)
+            cached = self._mapped.get(path, self._decoded.get(path))
+        telemetry.count("dataset_hits" if cached is not None else "dataset_misses")
+        if cached is not None:
+            return cached
+
+        arr = map_file_as_np(path, header, data_offset)
+        with self._cache_lock:
+            if isinstance(arr, np.memmap):
+                self._mapped[path] = arr
+            elif path not in self._decoded:
+                self._decoded[path] = arr
+                self._decoded_bytes += arr.nbytes
+                # Evict the least recently used files, but never the one just decoded
+                while self._decoded_bytes > self.max_decoded_bytes and len(self._decoded) > 1:
+                    _, evicted = self._decoded.popitem(last=False)
+                    self._decoded_bytes -= evicted.nbytes
+        return arr
+
+    def arrays(self, idx) -> tuple[np.ndarray, np.ndarray]:
+        return (self._array(self.vol_paths[idx], *self.vol_headers[idx]),
+                self._array(self.seg_paths[idx], *self.seg_headers[idx]))
+
+    def volume(self, idx) -> torch.Tensor:
+        """The volume of a case alone, without reading its label (e.g. when masks come from a label_store)."""
+        return torch.from_numpy(self._array(self.vol_paths[idx], *self.vol_headers[idx])).permute(self.reorder)
+
+    def release(self, idx):
+        """Drop a case's maps (or decoded arrays) so its memory can be reclaimed."""
+        with self._cache_lock:
+            for path in (self.vol_paths[idx], self.seg_paths[idx]):
+                self._mapped.pop(path, None)
+                decoded = self._decoded.pop(path, None)
+                if decoded is not None:
+                    self._decoded_bytes -= decoded.nbytes
+
+    def __getitem__(self, idx) -> tuple[torch.Tensor, torch.Tensor]:
+        volume, label = self.arrays(idx)
+        return torch.from_numpy(volume).permute(self.reorder), torch.from_numpy(label).permute(self.reorder)
+
+
+def load_data_as_tensors(active_datasets, 
+                         split=[1.0, 0.0, 0.0],    # train, validation, test
+                         reorder=(3, 2, 1, 0),
+                         seed=None,
+                         strata=None,
+                         rank=0,
+                         world_size=1,
+                         epoch=0):
+    # Split and shard on paths so each process only reads its own cases
+    splits = split_and_shard_paths(get_dataset_paths(active_datasets), split, seed, strata, rank, world_size, epoch)
+
+    # Load nrrd files, permute data and convert to tensor
+    out = []
+    for paths in splits:
+        data = load_paths_as_np(paths)
+        volumes, labels = [], []
+        for path, (volume, label) in zip(paths, data):
+            with telemetry.span("to_tensor", path, volume.nbytes + label.nbytes):
+                volume, label = torch.tensor(volume), torch.tensor(label)
+            with telemetry.span("permute", path):
+                volumes.append(volume.permute(reorder))
+                labels.append(label.permute(reorder))
+        out.append((volumes, labels))
+
+    # Return data as train, validation, test
+    train_data, validation_data, test_data = out
+    return train_data, validation_data, test_data
 
 if __name__ == "__main__":
     active_datasets = ["default"]
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from tqdm import tqdm
+
+import nrrd_cache
+import simulated_nrrd_loader
+import slice_shards
+
+
+store_dir = f"{Path('./').parent.absolute()}/data/slices"
+refs_name = "refs.json"
+num_workers = os.cpu_count()
+
+# Unique (image, mask) slices are stored once, as slice_shards records keyed by their content hash. refs.json maps
+# every case's (frame, slice) grid onto those keys. Shards are only ever added, so a key stays valid once written.
+
+
+def case_slices(vol_path: str, reorder=(3, 2, 1, 0)):
+    """Yield (frame index, (slice, a, b) images, (slice, a, b) masks) of one case in the loaders' orientation."""
+    frame_axes = tuple(reorder[1:])
+    seg_path = vol_path.replace("_vol", "_seg")
+    frames = zip(simulated_nrrd_loader.iter_file_frames(vol_path), simulated_nrrd_loader.iter_file_frames(seg_path))
+    for frame_i, (image, mask) in enumerate(frames):
+        yield frame_i, np.transpose(image, frame_axes), np.transpose(mask, frame_axes)
+
+
+def _digest(*arrays) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.dtype.str}{arr.shape}".encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def hash_case(vol_path: str, reorder=(3, 2, 1, 0)) -> dict:
+    """(frame, slice) grids of content keys for the (image, mask) pairs, and for images and masks alone."""
+    keys, image_keys, mask_keys = [], [], []
+    for _, images, masks in case_slices(vol_path, reorder):
+        keys.append([_digest(image, mask) for image, mask in zip(images, masks)])
+        image_keys.append([_digest(image) for image in images])
+        mask_keys.append([_digest(mask) for mask in masks])
+    return {"keys": keys, "image_keys": image_keys, "mask_keys": mask_keys}
+
+
+def write_case(vol_path: str, shard_path: str, keys: list, wanted: set, reorder=(3, 2, 1, 0)) -> int:
+    """Store the slices of one case whose keys are in wanted, each once, returning the number written."""
+    written = 0
+    with slice_shards.ShardWriter(shard_path) as writer:
+        for frame_i, images, masks in case_slices(vol_path, reorder):
+            for slice_i, (image, mask) in enumerate(zip(images, masks)):
+                key = keys[frame_i][slice_i]
+                if key in wanted:
+                    writer.write(key, image, mask)
+                    wanted.discard(key)
+                    written += 1
+    return written
+
+
+def _source(path: str, reorder) -> dict:
+    dtype = simulated_nrrd_loader.header_dtype(simulated_nrrd_loader.read_header(path)[0])
+    return nrrd_cache.source_key(path, reorder, dtype.newbyteorder("="))
+
+
+def load_refs(dataset: str) -> dict:
+    refs_path = os.path.join(store_dir, dataset, refs_name)
+    if not os.path.exists(refs_path):
+        return {}
+    with open(refs_path) as f:
+        return json.load(f)
+
+
+def save_refs(dataset: str, refs: dict):
+    refs_path = os.path.join(store_dir, dataset, refs_name)
+    with open(f"{refs_path}.tmp", "w") as f:
+        json.dump(refs, f)
+    os.replace(f"{refs_path}.tmp", refs_path)
+
+
+def next_shard_number(shard_dir: str) -> int:
+    """One past the highest shard number on disk (finished or not), so new shards never reuse a name."""
+    numbers = [int(name.split("_", 1)[0]) for name in os.listdir(shard_dir) if name.split("_", 1)[0].isdigit()]
+    return max(numbers, default=-1) + 1
+
+
+def build(dataset: str, reorder=(3, 2, 1, 0)) -> dict:
+    """Hash every case of a dataset and store the slices not already in the store, skipping unchanged cases."""
+    shard_dir = os.path.join(store_dir, dataset, "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    refs = load_refs(dataset)
+    vol_paths = simulated_nrrd_loader.get_dataset_paths([dataset])
+    sources = {path: [_source(path, reorder), _source(path.replace("_vol", "_seg"), reorder)] for path in vol_paths}
+    names = {path: os.path.basename(path)[:-len("_vol.nrrd")] for path in vol_paths}
+    jobs = [path for path in vol_paths if refs.get(names[path], {}).get("source") != sources[path]]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # Hash first, so each key is written by exactly one case even when duplicates span cases
+        hashed = dict(zip(jobs, tqdm(executor.map(hash_case, jobs, [reorder] * len(jobs)), total=len(jobs),
+                                     desc=f"Hashing {dataset}")))
+        reader = slice_shards.ShardReader(shard_dir)
+        stored, next_shard = set(reader.keys), next_shard_number(shard_dir)
+        futures = []
+        for path in jobs:
+            wanted = set(key for row in hashed[path]["keys"] for key in row) - stored
+            stored |= wanted
+            if wanted:
+                shard_path = os.path.join(shard_dir, f"{next_shard:05d}_{names[path]}")
+                next_shard += 1
+                if any(os.path.exists(f"{shard_path}{ext}") for ext in (slice_shards.data_ext, slice_shards.index_ext)):
+                    raise FileExistsError(f"Refusing to overwrite the existing shard {shard_path}")
+                futures.append(executor.submit(write_case, path, shard_path, hashed[path]["keys"], wanted, reorder))
+        for future in tqdm(futures, desc=f"Storing {dataset}"):
+            future.result()
+
+    for path in jobs:
+        refs[names[path]] = {"source": sources[path], **hashed[path]}
+    save_refs(dataset, refs)
+    return refs
+
+
+def duplicate_report(refs: dict) -> dict:
+    """Slice totals and duplicate ratios (1 - unique / total) for pairs, images and masks, plus repeated frames."""
+    report = {"cases": len(refs), "slices": 0}
+    for field in ("keys", "image_keys", "mask_keys"):
+        keys = [key for case in refs.values() for row in case[field] for key in row]
+        report["slices"] = len(keys)
+        report[f"unique_{field}"] = len(set(keys))
+        report[f"duplicate_{field}_ratio"] = 1 - len(set(keys)) / max(len(keys), 1)
+
+    # Frames identical to an earlier frame of the same case, e.g. from static phases of the cycle
+    report["frames"] = sum(len(case["keys"]) for case in refs.values())
+    report["repeated_frames"] = sum(len(case["keys"]) - len(set(map(tuple, case["keys"]))) for case in refs.values())
+    return report
+
+
+class SliceStore:
+    """(case, frame, slice) access to a deduplicated dataset."""
+
+    def __init__(self, dataset: str):
+        self.refs = load_refs(dataset)
+        self.reader = slice_shards.ShardReader(os.path.join(store_dir, dataset, "shards"))
+
+    def get(self, case: str, frame_i: int, slice_i: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.reader.get(self.refs[case]["keys"][frame_i][slice_i])
+
+    def unique_index(self, cases: list[str]) -> list[tuple[int, int, int]]:
+        """(case, frame, slice) of the first occurrence of every unique slice, over cases in the given order.
+
+        Pass it as a SliceBatchLoader index (with cases in dataset order) so an epoch visits each distinct slice once."""
+        seen, index = set(), []
+        for case_i, case in enumerate(cases):
+            for frame_i, row in enumerate(self.refs[case]["keys"]):
+                for slice_i, key in enumerate(row):
+                    if key not in seen:
+                        seen.add(key)
+                        index.append((case_i, frame_i, slice_i))
+        return index
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    for dataset in active_datasets:
+        report = duplicate_report(build(dataset))
+        print(f"{dataset}: {report['cases']} case(s), {report['slices']} slices, {report['repeated_frames']} of "
+              f"{report['frames']} frames repeated")
+        for field in ("keys", "image_keys", "mask_keys"):
+            print(f"  {field:10s} {report[f'unique_{field}']:8d} unique, {report[f'duplicate_{field}_ratio']:.1%} duplicate")
@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+import simulated_nrrd_loader
+
+
+class SliceBatchLoader:
+    """Iterate fixed-size batches of 2-D (frame, slice) images and masks gathered across many volumes.
+
+    Batches are filled by a thread pool into a ring of preallocated (optionally pinned) buffers, queue_depth
+    batches ahead of the trainer. Each yielded batch is a view of its buffer and is recycled once the next
+    batch is requested, so move or copy it before asking for another."""
+
+    def __init__(self, dataset: simulated_nrrd_loader.SimulatedNrrdDataset,
+                 batch_size=32,
+                 shuffle=True,
+                 seed=None,
+                 drop_last=False,
+                 num_workers=4,
+                 queue_depth=8,
+                 pin_memory=False,
+                 vol_dtype=torch.float32,
+                 seg_dtype=torch.int64,
+                 index=None,
+                 reslicer=None,
+                 view="short",
+                 positions=None,
+                 label_readers=None,
+                 resident_cases=4):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_workers = num_workers
+        self.queue_depth = max(queue_depth, 1)
+        self.epoch = 0
+
+        # Shuffled epochs draw from resident_cases cases at a time (see _batches), so only about that many (plus the
+        # cases of the batches in flight) are held at once, and each is decoded once per epoch
+        self.resident_cases = max(resident_cases, 1)
+
+        # Optionally sample resliced planes (see reslice.Reslicer) instead of stored slices; the slice entry of
+        # the index then selects one of the plane positions
+        self.reslicer = reslicer
+        self.view = view
+        self.positions = list(positions) if positions is not None else [0.0]
+
+        # Optionally decode stored slices' masks from label_store readers (one per case) instead of the label volumes
+        self.label_readers = label_readers
+
+        # Every case has to share an in-plane shape to be batched together
+        if reslicer is not None:
+            self.slice_shape = tuple(reslicer.size)
+            # Planes are laid out in millimetres, so each case is resliced at its own header spacing
+            for case_i in range(len(dataset)):
+                reslicer.set_voxel_size(case_i, dataset.voxel_size(case_i))
+        else:
+            shapes = set(dataset.shape(case_i)[2:] for case_i in range(len(dataset)))
+            if len(shapes) != 1:
+                raise simulated_nrrd_loader.DatasetError(f"Cases have differing slice shapes: {sorted(shapes)}")
+            self.slice_shape = shapes.pop()
+
+        # (case, frame, slice) for every slice, unless a subset (e.g. from a catalog query) is given
+        if index is None:
+            index = [(case_i, frame_i, slice_i) for case_i in range(len(dataset))
+                     for frame_i in range(dataset.shape(case_i)[0])
+                     for slice_i in range(len(self.positions) if reslicer is not None else dataset.shape(case_i)[1])]
+        self.index = np.asarray(index, dtype=np.int64).reshape(-1, 3)
+
+        # Preallocate the buffer ring
+        pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = [(torch.empty((batch_size, *self.slice_shape), dtype=vol_dtype, pin_memory=pin_memory),
+                          torch.empty((batch_size, *self.slice_shape), dtype=seg_dtype, pin_memory=pin_memory))
+                         for _ in range(self.queue_depth)]
+
+        # Guard first access of each case so two threads never decode the same file
+        self._case_locks = [threading.Lock() for _ in range(len(dataset))]
+
+        # Slices of each case still to be copied this epoch. Cases are held here from their first slice until this
+        # reaches 0, whatever the dataset's cache evicts meanwhile, and are then released from the dataset too
+        self._remaining = {}
+        self._resident = {}
+        self._remaining_lock = threading.Lock()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.index) // self.batch_size
+        return -(-len(self.index) // self.batch_size)
+
+    def set_epoch(self, epoch: int):
+        """Select the shuffle order for an epoch; the same seed and epoch always give the same batches."""
+        self.epoch = epoch
+
+    def _batches(self) -> list[np.ndarray]:
+        order = np.arange(len(self.index))
+        if self.shuffle:
+            # Shuffle the cases, then the slices within each block of resident_cases of them. A block's cases are
+            # used up (and released) before the next block starts, rather than being spread over the whole epoch
+            rng = np.random.default_rng(None if self.seed is None else [self.seed, self.epoch])
+            cases = rng.permutation(np.unique(self.index[:, 0]))
+            blocks = [np.flatnonzero(np.isin(self.index[:, 0], cases[start:start + self.resident_cases]))
+                      for start in range(0, len(cases), self.resident_cases)]
+            order = np.concatenate([rng.permutation(block) for block in blocks]) if blocks else order
+        batches = [self.index[order[start:start + self.batch_size]] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def _fill(self, batch: np.ndarray, buffer: tuple[torch.Tensor, torch.Tensor]) -> int:
+        images, masks = buffer
+        for i, (case_i, frame_i, slice_i) in enumerate(batch):
+            with self._case_locks[case_i]:
+                if case_i not in self._resident:
+                    self._resident[case_i] = self._open(case_i)
+                volume, label = self._resident[case_i]
+            if self.reslicer is not None:
+                image, mask = self.reslicer(case_i, volume[frame_i:frame_i + 1], label[frame_i:frame_i + 1],
+                                            self.view, self.positions[slice_i])
+                images[i].copy_(image[0])
+                masks[i].copy_(mask[0])
+            else:
+                images[i].copy_(volume[frame_i, slice_i])
+                if self.label_readers is not None:
+                    masks[i].copy_(torch.from_numpy(self.label_readers[case_i].slice(frame_i, slice_i)))
+                else:
+                    masks[i].copy_(label[frame_i, slice_i])
+            self._done(int(case_i))
+        return len(batch)
+
+    def _open(self, case_i: int) -> tuple[torch.Tensor, torch.Tensor]:
+        if self.label_readers is not None and self.reslicer is None:
+            # Masks come from the label store, so only the volume is read
+            return self.dataset.volume(case_i), None
+        volume, label = self.dataset[case_i]
+        if self.reslicer is not None:
+            # Fit the case's axis on its full label volume before sampling single frames
+            self.reslicer.axis(case_i, label)
+        return volume, label
+
+    def _done(self, case_i: int):
+        with self._remaining_lock:
+            self._remaining[case_i] -= 1
+            exhausted = self._remaining[case_i] == 0
+            if exhausted:
+                self._resident.pop(case_i, None)
+        if exhausted:
+            self.dataset.release(case_i)
+
+    def __iter__(self):
+        buffers = deque(self._buffers)
+        pending = deque()
+        batches = self._batches()
+        self._remaining = Counter(int(case_i) for batch in batches for case_i in batch[:, 0])
+        self._resident = {}
+        batches = iter(batches)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            def top_up():
+                # Hand every free buffer the next batch to fill
+                while len(buffers) > 0:
+                    batch = next(batches, None)
+                    if batch is None:
+                        return
+                    buffer = buffers.popleft()
+                    pending.append((executor.submit(self._fill, batch, buffer), buffer))
+
+            top_up()
+            while len(pending) > 0:
+                future, buffer = pending.popleft()
+                n = future.result()
+                yield buffer[0][:n], buffer[1][:n]
+
+                # The trainer is done with this buffer once it asks for the next batch
+                buffers.append(buffer)
+                top_up()
+
+
+if __name__ == "__main__":
+    active_datasets = ["19x256"]
+    dataset = simulated_nrrd_loader.SimulatedNrrdDataset(active_datasets)
+    loader = SliceBatchLoader(dataset, batch_size=64, seed=0)
+
+    start = time.perf_counter()
+    n_slices = 0
+    for images, masks in loader:
+        n_slices += len(images)
+    elapsed = time.perf_counter() - start
+    print(f"{len(loader)} batches, {n_slices} slices in {elapsed:.1f}s ({n_slices / elapsed:.0f} slices/s)")
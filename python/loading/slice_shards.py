@@ -0,0 +1,103 @@
+import glob
+import json
+import os
+import numpy as np
+
+
+# Shards are a flat .bin of back-to-back slice records plus a .idx.json describing where each record lives.
+# The index is written last, so a shard without an index is an interrupted write and is ignored by readers.
+data_ext = ".bin"
+index_ext = ".idx.json"
+
+
+class ShardWriter:
+    """Append (image, mask) slice records to one shard file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = []
+        self.offset = 0
+        self.fh = open(f"{path}{data_ext}.tmp", "wb")
+
+    def _write_array(self, arr: np.ndarray) -> dict:
+        arr = np.ascontiguousarray(arr)
+        entry = {"offset": self.offset, "shape": list(arr.shape), "dtype": arr.dtype.str}
+        self.fh.write(arr.tobytes())
+        self.offset += arr.nbytes
+        return entry
+
+    def write(self, key: str, image: np.ndarray, mask: np.ndarray = None):
+        record = {"key": key, "image": self._write_array(image)}
+        if mask is not None:
+            record["mask"] = self._write_array(mask)
+        self.records.append(record)
+
+    def close(self) -> int:
+        """Finalize the shard, returning its size in bytes."""
+        self.fh.close()
+        os.replace(f"{self.path}{data_ext}.tmp", f"{self.path}{data_ext}")
+        with open(f"{self.path}{index_ext}.tmp", "w") as f:
+            json.dump(self.records, f)
+        os.replace(f"{self.path}{index_ext}.tmp", f"{self.path}{index_ext}")
+        return self.offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Leave the partial .tmp behind on failure rather than publishing it
+        if exc_type is None:
+            self.close()
+        else:
+            self.fh.close()
+
+
+def _from_buffer(buffer, entry: dict) -> np.ndarray:
+    return np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=buffer, offset=entry["offset"])
+
+
+class ShardReader:
+    """Random access and streaming over every finished shard in a directory."""
+
+    def __init__(self, shard_dir: str):
+        self.shard_paths = sorted(path[:-len(index_ext)] for path in glob.glob(f"{shard_dir}/*{index_ext}"))
+
+        # Flatten the indexes into one (shard, record) list
+        self.records = []
+        self.shard_ranges = []
+        for shard_i, path in enumerate(self.shard_paths):
+            start = len(self.records)
+            with open(f"{path}{index_ext}") as f:
+                self.records.extend((shard_i, record) for record in json.load(f))
+            self.shard_ranges.append((start, len(self.records)))
+        self.keys = {record["key"]: i for i, (_, record) in enumerate(self.records)}
+
+        # Shards are mapped on first access
+        self._mapped = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def _map(self, shard_i: int) -> np.memmap:
+        if shard_i not in self._mapped:
+            self._mapped[shard_i] = np.memmap(f"{self.shard_paths[shard_i]}{data_ext}", dtype=np.uint8, mode="r")
+        return self._mapped[shard_i]
+
+    def __getitem__(self, i) -> tuple[str, np.ndarray, np.ndarray]:
+        shard_i, record = self.records[i]
+        buffer = self._map(shard_i)
+        mask = _from_buffer(buffer, record["mask"]) if "mask" in record else None
+        return record["key"], _from_buffer(buffer, record["image"]), mask
+
+    def get(self, key: str) -> tuple[np.ndarray, np.ndarray]:
+        return self[self.keys[key]][1:]
+
+    def __iter__(self):
+        # Stream shard by shard with one sequential read each instead of touching pages at random
+        for shard_i, path in enumerate(self.shard_paths):
+            with open(f"{path}{data_ext}", "rb") as f:
+                buffer = f.read()
+            start, end = self.shard_ranges[shard_i]
+            for _, record in self.records[start:end]:
+                mask = _from_buffer(buffer, record["mask"]) if "mask" in record else None
+                yield record["key"], _from_buffer(buffer, record["image"]), mask
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from intensity_stats import Histogram, RunningStats, merge, percentiles
+
+
+def histogram_of(*parts) -> Histogram:
+    """Histogram of each part on its own (as per case), merged."""
+    histogram = None
+    for part in parts:
+        case = Histogram.for_dtype(part.dtype).update(part)
+        histogram = case if histogram is None else histogram.merge(case)
+    return histogram
+
+
+@pytest.mark.parametrize("values", [
+    np.random.default_rng(0).uniform(0, 10000, 100_000).astype(np.float32),     # beyond 4096
+    np.random.default_rng(1).normal(-500, 100, 100_000),                       # negative
+    np.random.default_rng(2).uniform(0, 1, 100_000).astype(np.float32),        # within [0, 1)
+    np.random.default_rng(3).integers(-2**20, 2**20, 100_000, dtype=np.int32),  # too wide for exact bins
+])
+def test_float_percentiles_follow_the_data(values):
+    histogram = histogram_of(values)
+    assert not histogram.exact
+    for q in percentiles:
+        assert histogram.percentile(q) == pytest.approx(np.percentile(values, q), abs=histogram.width)
+
+
+def test_merge_across_ranges():
+    rng = np.random.default_rng(4)
+    parts = [rng.uniform(0, 1, 10_000), rng.uniform(-3, 0.5, 10_000), rng.uniform(100, 5000, 10_000)]
+    histogram, values = histogram_of(*parts), np.concatenate(parts)
+    assert histogram.counts.sum() == len(values)
+    for q in percentiles:
+        assert histogram.percentile(q) == pytest.approx(np.percentile(values, q), abs=histogram.width)
+
+
+def test_non_finite_values_are_skipped():
+    values = np.array([np.nan, np.inf, -np.inf, 1.0, 2.0, 3.0])
+    histogram = histogram_of(values)
+    assert histogram.counts.sum() == 3
+    assert histogram.percentile(50) == pytest.approx(2.0, abs=histogram.width)
+
+
+def test_integer_percentiles_are_exact():
+    rng = np.random.default_rng(5)
+    parts = [rng.integers(-1000, 3000, 50_000).astype(np.int16), rng.integers(-32768, 32767, 50_000).astype(np.int16)]
+    histogram, values = histogram_of(*parts), np.concatenate(parts)
+    assert histogram.exact
+    for q in percentiles:
+        assert histogram.percentile(q) == np.percentile(values, q, method="inverted_cdf")
+
+
+def test_round_trip_through_cached_partials():
+    rng = np.random.default_rng(6)
+    parts = [rng.normal(0, 1, 1000), rng.normal(50, 10, 1000)]
+    partials = [{"overall": RunningStats.of(values).to_list(), "labels": {},
+                 "histogram": Histogram.for_dtype(values.dtype).update(values).to_dict()} for values in parts]
+    overall, _, histogram = merge(partials)
+    direct = histogram_of(*parts)
+    assert overall.count == 2000
+    assert (histogram.start, histogram.exponent) == (direct.start, direct.exponent)
+    assert np.array_equal(histogram.counts, direct.counts)
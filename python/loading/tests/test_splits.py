@@ -0,0 +1,46 @@
+import pytest
+
+import simulated_nrrd_loader
+
+
+@pytest.mark.parametrize("stratum_size", [1, 2, 3, 5])
+def test_small_strata_keep_global_proportions(stratum_size):
+    paths = [f"case_{i:03d}_vol.nrrd" for i in range(100)]
+    strata = {path: i // stratum_size for i, path in enumerate(paths)}
+    train, validation, test = simulated_nrrd_loader.split_paths(paths, [0.8, 0.1, 0.1], seed=0, strata=strata)
+    assert (len(train), len(validation), len(test)) == (80, 10, 10)
+    assert sorted(train + validation + test) == sorted(paths)
+
+
+def test_unstratified_split():
+    paths = [f"case_{i:03d}_vol.nrrd" for i in range(10)]
+    train, validation, test = simulated_nrrd_loader.split_paths(paths, [0.7, 0.2, 0.1], seed=1)
+    assert (len(train), len(validation), len(test)) == (7, 2, 1)
+
+
+@pytest.mark.parametrize("balance", [None, "drop"])
+@pytest.mark.parametrize("world_size", [2, 3, 4])
+def test_shards_are_disjoint_and_cover_every_path(world_size, balance):
+    paths = [f"case_{i:03d}_vol.nrrd" for i in range(11)]
+    shards = [simulated_nrrd_loader.shard_paths(paths, rank, world_size, seed=5, epoch=2, balance=balance)
+              for rank in range(world_size)]
+    flat = [path for shard in shards for path in shard]
+    assert len(flat) == len(set(flat))
+    if balance is None:
+        assert sorted(flat) == sorted(paths)
+    else:
+        assert len(set(len(shard) for shard in shards)) == 1
+
+
+def test_sharding_without_a_seed_is_refused():
+    with pytest.raises(ValueError):
+        simulated_nrrd_loader.shard_paths(["a_vol.nrrd", "b_vol.nrrd"], 0, 2)
+    assert simulated_nrrd_loader.shard_paths(["a_vol.nrrd", "b_vol.nrrd"]) == ["a_vol.nrrd", "b_vol.nrrd"]
+
+
+def test_large_strata_are_each_split_by_proportion():
+    paths = [f"case_{i:03d}_vol.nrrd" for i in range(100)]
+    strata = {path: i % 2 for i, path in enumerate(paths)}
+    splits = simulated_nrrd_loader.split_paths(paths, [0.8, 0.1, 0.1], seed=3, strata=strata)
+    for stratum in (0, 1):
+        assert [sum(strata[path] == stratum for path in part) for part in splits] == [40, 5, 5]
@@ -0,0 +1,157 @@
+from pathlib import Path
+import glob
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from tqdm import tqdm
+
+import generate_phantoms
+
+
+mesh_dir = f"{Path('./').parent.absolute()}/assets/heart_npz_models"    # see the "NPZ" format in blender/export.py
+out_dir = f"{Path('./').parent.absolute()}/data/unprocessed"
+dataset = "voxelized_19x256"
+num_workers = os.cpu_count()
+n_slices = 19
+size = 256                      # in-plane voxels
+spacing = (1.5, 1.5, 8.0)       # x, y, slice spacing in mm
+unit_scale = 10.0               # mesh units to mm (the blender scene is in cm after fixups.correct_scale)
+max_candidates = 1 << 22        # (triangle, ray) pairs tested at once
+
+# Later components overwrite earlier ones where meshes overlap, as in generate_phantoms
+paint_order = ["la", "ra", "rv", "svc", "pa", "a", "m", "lv"]
+
+
+def load_mesh_frame(path: str) -> dict:
+    """{component: (vertices (n, 3) in mm, triangles (m, 3))} from one exported frame."""
+    with np.load(path) as data:
+        names = [key[:-len("_vertices")] for key in data.files if key.endswith("_vertices")]
+        return {name: (data[f"{name}_vertices"].astype(np.float64) * unit_scale, data[f"{name}_faces"].astype(np.int64))
+                for name in names}
+
+
+def case_frames(mesh_dir: str) -> dict:
+    """{case name: [frame paths in frame order]} for every {case}_frame_{n}.npz under mesh_dir."""
+    cases = {}
+    for path in glob.glob(f"{mesh_dir}/*_frame_*.npz"):
+        match = re.fullmatch(r"(.+)_frame_(\d+)\.npz", os.path.basename(path))
+        cases.setdefault(match.group(1), []).append((int(match.group(2)), path))
+    return {case: [path for _, path in sorted(frames)] for case, frames in sorted(cases.items())}
+
+
+def grid_coords(meshes: dict) -> list[np.ndarray]:
+    """Physical (x, y, z) voxel centre coordinates of a grid centred on the meshes' bounding box."""
+    points = np.concatenate([vertices for vertices, _ in meshes.values()])
+    center = (points.min(axis=0) + points.max(axis=0)) / 2
+    return [center[axis] + (np.arange(count) - (count - 1) / 2) * spacing[axis]
+            for axis, count in enumerate((size, size, n_slices))]
+
+
+def voxelize(vertices: np.ndarray, faces: np.ndarray, coords) -> np.ndarray:
+    """Inside/outside test of every (slice, y, x) voxel centre against a closed triangle mesh.
+
+    Casts one ray along +x per (slice, y) row and counts crossings (ray parity): each triangle is tested only
+    against the rows inside its (y, z) bounding box, and crossings are accumulated as flips that a cumulative
+    sum along x turns into the inside mask."""
+    xs, ys, zs = coords
+    triangles = vertices[faces]
+
+    # Nudge the mesh off the ray grid so no ray passes exactly through an edge or vertex
+    triangles[..., 1] += spacing[1] * 1.234567e-4
+    triangles[..., 2] += spacing[2] * 2.345678e-4
+
+    lo, hi = triangles.min(axis=1), triangles.max(axis=1)
+    iy0, iy1 = np.searchsorted(ys, lo[:, 1]), np.searchsorted(ys, hi[:, 1], side="right")
+    iz0, iz1 = np.searchsorted(zs, lo[:, 2]), np.searchsorted(zs, hi[:, 2], side="right")
+    ny, nz = np.maximum(iy1 - iy0, 0), np.maximum(iz1 - iz0, 0)
+    counts = ny * nz
+
+    flips = np.zeros(len(zs) * len(ys) * (len(xs) + 1), dtype=np.int32)
+    tri_ids = np.flatnonzero(counts)
+    chunk_ids = (np.cumsum(counts[tri_ids]) - 1) // max_candidates
+    for chunk in np.split(tri_ids, np.flatnonzero(np.diff(chunk_ids)) + 1):
+        # One candidate per (triangle, row) pair in the triangle's bounding box
+        chunk_counts = counts[chunk]
+        tri = np.repeat(chunk, chunk_counts)
+        local = np.arange(len(tri)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        jy = iy0[tri] + local % ny[tri]
+        jz = iz0[tri] + local // ny[tri]
+
+        # 2-D edge functions in (y, z) give the barycentric weights of the ray within the triangle
+        a, b, c = triangles[tri, 0], triangles[tri, 1], triangles[tri, 2]
+        py, pz = ys[jy], zs[jz]
+        wa = (c[:, 1] - b[:, 1]) * (pz - b[:, 2]) - (c[:, 2] - b[:, 2]) * (py - b[:, 1])
+        wb = (a[:, 1] - c[:, 1]) * (pz - c[:, 2]) - (a[:, 2] - c[:, 2]) * (py - c[:, 1])
+        wc = (b[:, 1] - a[:, 1]) * (pz - a[:, 2]) - (b[:, 2] - a[:, 2]) * (py - a[:, 1])
+        area = wa + wb + wc
+        hit = (area != 0) & (wa * area >= 0) & (wb * area >= 0) & (wc * area >= 0)
+
+        # Every voxel past the crossing flips between outside and inside
+        x = (wa[hit] * a[hit, 0] + wb[hit] * b[hit, 0] + wc[hit] * c[hit, 0]) / area[hit]
+        ix = np.searchsorted(xs, x)
+        flips += np.bincount((jz[hit] * len(ys) + jy[hit]) * (len(xs) + 1) + ix, minlength=len(flips)).astype(np.int32)
+
+    flips = flips.reshape(len(zs), len(ys), len(xs) + 1)
+    return (np.cumsum(flips, axis=-1, dtype=np.int32)[..., :len(xs)] & 1).astype(bool)
+
+
+def voxelize_frame(path: str, first_path: str) -> np.ndarray:
+    """(slice, y, x) labels of one frame, on the grid fitted to the case's first frame so all frames line up."""
+    coords = grid_coords(load_mesh_frame(first_path))
+    meshes = load_mesh_frame(path)
+    labels = np.zeros((n_slices, size, size), dtype=np.uint8)
+    for name in paint_order:
+        if name in meshes:
+            labels[voxelize(*meshes[name], coords)] = generate_phantoms.LABELS[name]
+    return labels
+
+
+def write_case(path_prefix: str, labels: np.ndarray, origin) -> str:
+    volume = generate_phantoms.synthesize_intensities(labels, spacing, zlib.crc32(os.path.basename(path_prefix).encode()))
+    generate_phantoms.write_case(path_prefix, volume, labels, spacing, origin)
+    return path_prefix
+
+
+def main():
+    dataset_dir = os.path.join(out_dir, dataset)
+    os.makedirs(dataset_dir, exist_ok=True)
+    cases = {case: paths for case, paths in case_frames(mesh_dir).items()
+             if not generate_phantoms.case_exists(os.path.join(dataset_dir, case))}
+    print(f"Voxelizing {len(cases)} case(s) from '{mesh_dir}' into '{dataset_dir}'")
+
+    # Frames are voxelized independently, submitted case by case in a bounded window so only a few cases are
+    # partly done at once; each case is written as soon as its last frame is in
+    frame_tasks = iter([(case, frame_i, path) for case, paths in cases.items() for frame_i, path in enumerate(paths)])
+    max_in_flight = 2 * num_workers
+    frames = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+            tqdm(total=sum(len(paths) for paths in cases.values()), desc="Voxelizing") as progress:
+        pending = {}
+        while True:
+            for case, frame_i, path in frame_tasks:
+                pending[executor.submit(voxelize_frame, path, cases[case][0])] = (case, frame_i)
+                frames.setdefault(case, [None] * len(cases[case]))
+                if len(pending) >= max_in_flight:
+                    break
+            if len(pending) == 0:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, result = pending.pop(future), future.result()
+                if task is None:
+                    # A case was written
+                    continue
+                case, frame_i = task
+                frames[case][frame_i] = result
+                progress.update()
+                if all(frame is not None for frame in frames[case]):
+                    origin = [coords[0] for coords in grid_coords(load_mesh_frame(cases[case][0]))]
+                    labels = np.stack(frames.pop(case))
+                    pending[executor.submit(write_case, os.path.join(dataset_dir, case), labels, origin)] = None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,82 +1,226 @@
+from collections import OrderedDict, deque
+import time
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 from matplotlib.widgets import Slider, Button
+from matplotlib.animation import FuncAnimation
 
 
 import python.loading.simulated_nrrd_loader as simulated_nrrd_loader
+import python.loading.reslice as reslice
 
 active_datasets = ["19x256"]
-split = [1.0, 0.0, 0.0]
+cache_bytes = 2 * 1024**3      # memory cap for recently viewed scans
+cine_fps = 30                  # target cine playback rate
+views = ["stored", "short", "long"]   # cycled with the 'v' key
+axis_labels = (1, 2)           # labels the long axis is fitted to for resliced views
 label_cmap = mcolors.ListedColormap(['black', 'red', 'orange', 'blue', 'yellow', 'green', 'pink', 'lime', 'purple'])
 
-(train_data, train_labels), (validation_data, validation_labels), (test_data, test_labels) = simulated_nrrd_loader.load_data_as_tensors(active_datasets, split)
-print(torch.equal(train_data[0][0], train_data[0][1]))
 
-# print(f"shape: {train_labels[0].shape}")
-# num_unique_labels = torch.unique(train_labels[0]).numel()
-# unique_labels = torch.unique(train_labels[0], return_counts=True)
-# for i in range(num_unique_labels):
-#     print(f"{unique_labels[0][i]}: {unique_labels[1][i]}")
+class VolumeCache:
+    """LRU cache of viewed scans, each stored with its per-(frame, slice) intensity range."""
 
+    def __init__(self, dataset, max_bytes=cache_bytes):
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
 
-def show_slice_gui(data, label):
+    def get(self, scan_idx) -> tuple[torch.Tensor, torch.Tensor, np.ndarray]:
+        if scan_idx in self.entries:
+            self.entries.move_to_end(scan_idx)
+            return self.entries[scan_idx]
+
+        # Load only this scan, and compute its contrast limits once
+        volume, label = self.dataset[scan_idx]
+        volume, label = volume.contiguous(), label.contiguous()
+        self.dataset.release(scan_idx)
+        limits = torch.stack((volume.amin(dim=(-2, -1)), volume.amax(dim=(-2, -1))), dim=-1).numpy()
+        entry = (volume, label, limits)
+
+        # Evict least recently viewed scans over the memory cap, always keeping the current one
+        self.entries[scan_idx] = entry
+        self.n_bytes += self._size(entry)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= self._size(evicted)
+        return entry
+
+    @staticmethod
+    def _size(entry) -> int:
+        volume, label, limits = entry
+        return volume.nbytes + label.nbytes + limits.nbytes
+
+
+def frame_stacks(data_planes, label_planes) -> tuple[np.ndarray, np.ndarray]:
+    """Pre-decode every cardiac frame of one (frame, a, b) plane series as contiguous, display-oriented arrays for cine playback."""
+    data_stack = np.ascontiguousarray(data_planes.permute(0, 2, 1).numpy())
+    label_stack = np.ascontiguousarray(label_planes.permute(0, 2, 1).numpy())
+    return data_stack, label_stack
+
+
+def show_slice_gui(dataset):
     # Scan, frame, slice initialization
-    n_scans = len(data)
+    cache = VolumeCache(dataset)
+    n_scans = len(dataset)
     scan_idx = 0
-    n_frames = len(data[0])
+    n_frames, n_slices = dataset.shape(scan_idx)[:2]
     frame_idx = 0
-    n_slices = len(data[0][0])
     slice_idx = 0
-    
+    data, label, limits = cache.get(scan_idx)
+
     fig, axes = plt.subplots(1, 2, figsize=(10, 5))
     plt.subplots_adjust(bottom=0.30)  # space for 3 sliders
 
     # Data figure
-    data_slice = data[scan_idx][frame_idx][slice_idx].permute(1, 0)
+    data_slice = data[frame_idx][slice_idx].permute(1, 0)
     im_data = axes[0].imshow(data_slice, origin='lower', cmap='gray')
+    im_data.set_clim(*limits[frame_idx][slice_idx])
     axes[0].set_title("Data Slice")
 
-    # Label figure
-    label_slice = label[scan_idx][frame_idx][slice_idx].permute(1, 0)
-    im_label = axes[1].imshow(label_slice, origin='lower', cmap=label_cmap)
+    # Label figure (fixed limits so each label keeps its colour)
+    label_slice = label[frame_idx][slice_idx].permute(1, 0)
+    im_label = axes[1].imshow(label_slice, origin='lower', cmap=label_cmap, vmin=0, vmax=label_cmap.N - 1,
+                              interpolation='nearest')
     axes[1].set_title("Label Slice")
 
     # Title
     fig.suptitle(f"Scan {scan_idx}, Frame {frame_idx}, Slice {slice_idx}")
+    fps_text = axes[0].text(0.02, 0.95, "", transform=axes[0].transAxes, color='yellow', va='top')
 
     # Sliders
     scan_ax_slider = plt.axes([0.2, 0.15, 0.6, 0.03])
-    scan_slider = Slider(scan_ax_slider, 'Scan', 0, n_scans - 1, valinit=scan_idx, valstep=1)
+    scan_slider = Slider(scan_ax_slider, 'Scan', 0, max(n_scans - 1, 1), valinit=scan_idx, valstep=1)
     frame_ax_slider = plt.axes([0.2, 0.10, 0.6, 0.03])
-    frame_slider = Slider(frame_ax_slider, 'Frame', 0, n_frames - 1, valinit=frame_idx, valstep=1)
+    frame_slider = Slider(frame_ax_slider, 'Frame', 0, max(n_frames - 1, 1), valinit=frame_idx, valstep=1)
     slice_ax_slider = plt.axes([0.2, 0.05, 0.6, 0.03])
-    slice_slider = Slider(slice_ax_slider, 'Slice', 0, n_slices - 1, valinit=slice_idx, valstep=1)
+    slice_slider = Slider(slice_ax_slider, 'Slice', 0, max(n_slices - 1, 1), valinit=slice_idx, valstep=1)
+
+    # Reslicing state
+    reslicer = reslice.Reslicer(labels=axis_labels)
+    view = {"name": "stored", "key": None, "planes": None}
+
+    def current_planes(scan_idx, slice_idx):
+        """(frame, a, b) data and label planes plus per-frame limits for the current view."""
+        data, label, limits = cache.get(scan_idx)
+        if view["name"] == "stored":
+            return data[:, slice_idx], label[:, slice_idx], limits[:, slice_idx]
+
+        # Resliced planes are computed for every frame at once and reused while only the frame changes
+        key = (scan_idx, view["name"], slice_idx)
+        if view["key"] != key:
+            n_slices = len(data[0])
+            reslicer.set_voxel_size(scan_idx, dataset.voxel_size(scan_idx))
+            reslicer.size = tuple(data.shape[-2:])
+            if view["name"] == "short":
+                position = (slice_idx - (n_slices - 1) / 2) * max(reslicer.case_voxel_size(scan_idx))
+            else:
+                position = np.pi * slice_idx / n_slices
+            data_planes, label_planes = reslicer(scan_idx, data, label, view["name"], position)
+            plane_limits = torch.stack((data_planes.amin(dim=(-2, -1)), data_planes.amax(dim=(-2, -1))), dim=-1).numpy()
+            view["key"], view["planes"] = key, (data_planes, label_planes, plane_limits)
+        return view["planes"]
 
     def update(val):
         # Update values
-        scan_idx = int(scan_slider.val)
-        frame_idx = int(frame_slider.val)
-        slice_idx = int(slice_slider.val)
+        scan_idx = min(int(scan_slider.val), n_scans - 1)
+        data, label, limits = cache.get(scan_idx)
+        frame_idx = min(int(frame_slider.val), len(data) - 1)
+        slice_idx = min(int(slice_slider.val), len(data[0]) - 1)
+
+        # Keep the frame/slice sliders in range of the current scan
+        for slider, n in ((frame_slider, len(data)), (slice_slider, len(data[0]))):
+            slider.valmax = max(n - 1, 1)
+            slider.ax.set_xlim(slider.valmin, slider.valmax)
 
         # Get slices from array
-        data_slice = data[scan_idx][frame_idx][slice_idx].permute(1, 0)
-        label_slice = label[scan_idx][frame_idx][slice_idx].permute(1, 0)
+        data_planes, label_planes, plane_limits = current_planes(scan_idx, slice_idx)
+        data_slice = data_planes[frame_idx].permute(1, 0)
+        label_slice = label_planes[frame_idx].permute(1, 0)
 
         # Update images
         im_data.set_data(data_slice)
-        im_data.set_clim(vmin=data_slice.min(), vmax=data_slice.max())  # dynamic normalization
+        im_data.set_clim(*plane_limits[frame_idx])  # precomputed per-slice normalization
         im_label.set_data(label_slice)
-        im_label.set_clim(vmin=label_slice.min(), vmax=label_slice.max())
 
-        fig.suptitle(f"Scan {scan_idx}, Frame {frame_idx}, Slice {slice_idx}")
+        fig.suptitle(f"Scan {scan_idx}, Frame {frame_idx}, Slice {slice_idx} ({view['name']} view)")
+        fig.canvas.draw_idle()
+
+    # Cine playback state
+    cine = {"playing": False, "frame": 0, "stacks": None, "limits": None, "ticks": deque(maxlen=30), "animation": None}
+
+    def load_stacks():
+        scan_idx = min(int(scan_slider.val), n_scans - 1)
+        data, label, limits = cache.get(scan_idx)
+        slice_idx = min(int(slice_slider.val), len(data[0]) - 1)
+        data_planes, label_planes, plane_limits = current_planes(scan_idx, slice_idx)
+        cine["stacks"] = frame_stacks(data_planes, label_planes)
+        cine["limits"] = plane_limits
+        cine["frame"] = min(int(frame_slider.val), len(data) - 1)
+        cine["ticks"].clear()
+
+    def step(_):
+        # Only the two images and the frame rate readout are redrawn; everything else is blitted from cache
+        if not cine["playing"]:
+            return im_data, im_label, fps_text
+        data_stack, label_stack = cine["stacks"]
+        frame_idx = cine["frame"] = (cine["frame"] + 1) % len(data_stack)
+        im_data.set_data(data_stack[frame_idx])
+        im_data.set_clim(*cine["limits"][frame_idx])
+        im_label.set_data(label_stack[frame_idx])
+
+        ticks = cine["ticks"]
+        ticks.append(time.perf_counter())
+        if len(ticks) > 1:
+            fps_text.set_text(f"frame {frame_idx}  {(len(ticks) - 1) / (ticks[-1] - ticks[0]):.1f} FPS")
+        return im_data, im_label, fps_text
+
+    # Play/pause button
+    play_ax = plt.axes([0.85, 0.10, 0.1, 0.05])
+    play_button = Button(play_ax, 'Play')
+
+    def toggle(event):
+        if cine["playing"]:
+            cine["playing"] = False
+            cine["animation"].pause()
+            play_button.label.set_text('Play')
+            fps_text.set_text("")
+            frame_slider.set_val(cine["frame"])    # leave the sliders on the frame playback stopped at
+        else:
+            load_stacks()
+            cine["playing"] = True
+            play_button.label.set_text('Pause')
+            if cine["animation"] is None:
+                # Created on the first Play, so no timer runs before anything is played; it starts on the next draw
+                cine["animation"] = FuncAnimation(fig, step, interval=1000 / cine_fps, blit=True,
+                                                  cache_frame_data=False)
+            else:
+                cine["animation"].resume()
         fig.canvas.draw_idle()
 
-    scan_slider.on_changed(update)
+    def on_slider(val):
+        update(val)
+        if cine["playing"]:
+            load_stacks()
+
+    def on_key(event):
+        # Cycle between the stored slices and the resliced cardiac views
+        if event.key != 'v':
+            return
+        view["name"] = views[(views.index(view["name"]) + 1) % len(views)]
+        on_slider(None)
+
+    fig.canvas.mpl_connect('key_press_event', on_key)
+    play_button.on_clicked(toggle)
+    scan_slider.on_changed(on_slider)
     frame_slider.on_changed(update)
-    slice_slider.on_changed(update)
+    slice_slider.on_changed(on_slider)
     plt.show()
 
 
-show_slice_gui(train_data, train_labels)
+if __name__ == "__main__":
+    # Only headers are read here; scans are loaded as they are viewed
+    dataset = simulated_nrrd_loader.SimulatedNrrdDataset(active_datasets)
+    show_slice_gui(dataset)